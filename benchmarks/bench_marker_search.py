@@ -0,0 +1,70 @@
+"""Compares full resolution and pyramid marker search on recorded frames.
+
+Run from the repository root:
+    python -m benchmarks.bench_marker_search uploads/latest.jpg
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from src.camera_utils import (decode_image, decode_image_pyramid, get_all_markers, get_all_markers_pyramid,
+                              get_marker_positions, get_camera_matrix_and_dist_coeffs)
+
+MARKER_SIZE = 0.036
+MARKER_SPACING = 0.005
+
+def time_call(func, *args, repeat=10):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return result, np.median(times) * 1000
+
+def solve_pose(object_points, image_points, camera_matrix, dist_coeffs):
+    _, rvec, tvec = cv2.solvePnP(object_points, image_points, camera_matrix, dist_coeffs, flags=cv2.SOLVEPNP_ITERATIVE)
+    proj, _ = cv2.projectPoints(object_points, rvec, tvec, camera_matrix, dist_coeffs)
+    error = np.mean(np.linalg.norm(image_points - proj.reshape(-1, 2), axis=1))
+    R, _ = cv2.Rodrigues(rvec)
+    return (-R.T @ tvec).flatten(), error
+
+def bench(path, reduction, repeat):
+    with open(path, "rb") as f:
+        image_bytes = f.read()
+    marker_positions = get_marker_positions(MARKER_SIZE, MARKER_SPACING)
+    camera_matrix, dist_coeffs = get_camera_matrix_and_dist_coeffs()
+
+    img, full_decode = time_call(decode_image, image_bytes, repeat=repeat)
+    (_, reduced_img), pyramid_decode = time_call(decode_image_pyramid, image_bytes, reduction, repeat=repeat)
+    _, reduced_only = time_call(cv2.imdecode, np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_REDUCED_COLOR_4, repeat=repeat)
+    (full_obj, full_img_points), full_search = time_call(get_all_markers, img, marker_positions, MARKER_SIZE, repeat=repeat)
+    (pyr_obj, pyr_img_points), pyramid_search = time_call(get_all_markers_pyramid, img, reduced_img, marker_positions,
+                                                          MARKER_SIZE, repeat=repeat)
+
+    print(f"{path} {img.shape[1]}x{img.shape[0]}, reduction {reduction}")
+    print(f"  decode   full {full_decode:8.2f} ms   full + reduced {pyramid_decode:8.2f} ms   reduced only {reduced_only:8.2f} ms")
+    #the pyramid still decodes the full frame for the refinement, YOLO and the overlay, so its decode costs more
+    print(f"  decode cost of the pyramid {pyramid_decode - full_decode:+8.2f} ms (the full frame is still decoded)")
+    print(f"  markers  full {full_search:8.2f} ms   pyramid {pyramid_search:8.2f} ms")
+    print(f"  decode + markers  full {full_decode + full_search:8.2f} ms   pyramid {pyramid_decode + pyramid_search:8.2f} ms")
+    if full_obj is None or pyr_obj is None:
+        print("  markers not found by", "full search" if full_obj is None else "pyramid search")
+        return
+
+    full_position, full_error = solve_pose(full_obj, full_img_points, camera_matrix, dist_coeffs)
+    pyr_position, pyr_error = solve_pose(pyr_obj, pyr_img_points, camera_matrix, dist_coeffs)
+    print(f"  markers found  full {len(full_obj) // 4}   pyramid {len(pyr_obj) // 4}")
+    print(f"  reprojection error  full {full_error:.3f} px   pyramid {pyr_error:.3f} px")
+    print(f"  camera position difference {np.linalg.norm(full_position - pyr_position) * 1000:.2f} mm")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--reduction", type=int, default=4, choices=[2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    for path in args.images:
+        bench(path, args.reduction, args.repeat)
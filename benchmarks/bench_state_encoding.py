@@ -0,0 +1,72 @@
+"""Compares the response encodings of the polling and command endpoints.
+
+Run from the repository root:
+    python -m benchmarks.bench_state_encoding --boxes 20
+"""
+import argparse
+import json
+import time
+from dataclasses import dataclass, asdict
+
+import numpy as np
+from flask import Flask
+
+from src.state_encoding import NumpyJSONProvider, encode_msgpack, encode_state_struct, msgpack, orjson
+
+@dataclass
+class Box:
+    id: int
+    grab_point: list
+    width: float
+    length: float
+    height: float
+
+    def to_dict(self):
+        d = asdict(self)
+        d["grab_point"] = d["grab_point"].tolist()
+        return d
+
+def time_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat * 1e6, len(result)
+
+def bench(box_count, repeat):
+    rng = np.random.default_rng(0)
+    boxes = [Box(np.int32(i), rng.uniform(-0.2, 0.2, 3), *rng.uniform(0.02, 0.1, 3)) for i in range(box_count)]
+    world = rng.uniform(-0.2, 0.2, 3)
+    arm = rng.uniform(-0.2, 0.2, 3)
+    angles = rng.integers(0, 180, 5)
+
+    app = Flask(__name__)
+    provider = NumpyJSONProvider(app)
+
+    def tolist_json():
+        #what the endpoints did before: tolist() everywhere and the standard encoder
+        data = {'success': True, 'worldCoords': world.tolist(), 'armCoords': arm.tolist(),
+                'angles': [int(x) for x in angles], 'boxes': [box.to_dict() for box in boxes]}
+        return json.dumps(data, default=provider.default, separators=(",", ":"), sort_keys=True).encode()
+
+    data = {'success': True, 'worldCoords': world, 'armCoords': arm, 'angles': angles, 'boxes': boxes}
+    encoders = [
+        ("json (tolist + stdlib)", tolist_json),
+        ("json provider" + (" (orjson)" if orjson is not None else ""),
+         lambda: provider.dumps(data, separators=(",", ":")).encode()),
+        ("fixed layout struct", lambda: encode_state_struct(world, arm, angles, boxes)),
+    ]
+    if msgpack is not None:
+        encoders.append(("msgpack", lambda: encode_msgpack(data)))
+
+    print(f"{box_count} boxes")
+    for name, encoder in encoders:
+        us, size = time_call(encoder, repeat)
+        print(f"  {name:<24}{us:>10.1f} us {size:>8} bytes")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boxes", type=int, nargs="+", default=[0, 5, 50])
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+    for box_count in args.boxes:
+        bench(box_count, args.repeat)
@@ -0,0 +1,77 @@
+"""Load test of the polling and command endpoints of a running server.
+
+Run from the repository root against the development server or gunicorn:
+    python -m benchmarks.load_test --url http://127.0.0.1:5000 --concurrency 16 --duration 10
+
+The command endpoint jogs by a zero delta, so the arm doesn't move.
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+ENDPOINTS = {
+    "status": ("GET", "/api/status", None),
+    "state": ("GET", "/api/state", None),
+    "cam_data": ("GET", "/api/cam_data", None),
+    "calibration": ("GET", "/api/calibration", None),
+    "jog": ("POST", "/api/jog", {"delta": [0, 0, 0]}),
+}
+
+def run_client(url, endpoints, deadline, results, offset=0):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+    #the clients start at different endpoints, so every endpoint is under load all the time
+    i = offset
+    while time.perf_counter() < deadline:
+        name = endpoints[i % len(endpoints)]
+        i += 1
+        method, path, body = ENDPOINTS[name]
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status < 400
+        except (OSError, http.client.HTTPException):
+            ok = False
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        results.append((name, time.perf_counter() - start, ok))
+    conn.close()
+
+def print_report(results, elapsed):
+    print(f"{'endpoint':<14}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    names = sorted({name for name, _, _ in results}) + ["all"]
+    for name in names:
+        rows = [r for r in results if name == "all" or r[0] == name]
+        latencies = np.array([latency for _, latency, _ in rows]) * 1000
+        errors = sum(not ok for _, _, ok in rows)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"{name:<14}{len(rows):>10}{errors:>8}{len(rows) / elapsed:>10.1f}{p50:>10.2f}{p95:>10.2f}{p99:>10.2f}{latencies.max():>10.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--endpoints", nargs="+", choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    args = parser.parse_args()
+
+    #every client thread keeps one connection open and appends to its own list
+    results = [[] for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=run_client, args=(args.url, args.endpoints, deadline, results[i], i))
+               for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print_report([r for client_results in results for r in client_results], elapsed)
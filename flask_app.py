@@ -1,5 +1,5 @@
 import cv2
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, request, jsonify, send_file, render_template, g, Response
 import serial
 import serial.tools.list_ports
 import time
@@ -8,25 +8,30 @@ import numpy as np
 import socket
 import logging
 import base64
-from flask.json.provider import DefaultJSONProvider
+import json
+import threading
+import functools
+import atexit
 
 from src.box_detection import get_box_coordinates, Box
-from src.camera_utils import decode_image, get_camera_position, get_marker_positions, get_camera_matrix_and_dist_coeffs
-from src.movement import (get_move_angles, get_initial_angles,
+from src.camera_utils import decode_image_pyramid, get_camera_position, get_marker_positions, get_camera_matrix_and_dist_coeffs
+from src.movement import (get_initial_angles,
                           conv_camera_coords_to_gripper_coords, get_gripper_coords_and_cam_rotation_from_arm,
                           transform_arm_to_world_coords, transform_world_to_arm_coords,
-                          get_translation, world_to_servo_angles, servo_to_world_angle)
+                          get_translation, world_to_servo_angles, servo_to_world_angle,
+                          get_rotation_matrix, get_jog_angles, get_move_angles_refined, JointAngles, IK_TOLERANCE)
+from src.pick_scheduler import schedule_picks
+from src.session_recording import SessionRecorder, FRAME, SERIAL_OUT, SERIAL_IN
+from src.serial_connection import SerialConnection, FIRMWARE_READY_BANNER
+from src.camera_stream import CameraStream, STREAM_CHUNK_SIZE
+from src.reachability import ReachabilityMap, UnreachableTargetError
+from src.ik_cache import IKCache
+from src.history import HistoryStore, STREAM_DTYPES
+from src.calibration_fusion import ArmTransformEstimator
+from src.motion_program import MotionProgramRunner, MotionProgramError, parse_steps, GRIPPER_SERVO_ID
+from src.state_encoding import (NumpyJSONProvider, encode_msgpack, encode_state_struct, get_response_mimetypes,
+                                JSON_MIMETYPE, MSGPACK_MIMETYPE, STATE_MIMETYPE)
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE" #TODO
-class NumpyJSONProvider(DefaultJSONProvider):
-    def default(self, obj):
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        if isinstance(obj, (np.integer,)):
-            return int(obj)
-        if isinstance(obj, (np.floating,)):
-            return float(obj)
-        return super().default(obj)
-
 class IgnoreEndpointsFilter(logging.Filter):
     def __init__(self, ignored_paths):
         super().__init__()
@@ -47,6 +52,7 @@ log = logging.getLogger("werkzeug")
 log.addFilter(IgnoreEndpointsFilter(ignored_endpoints))
 
 app = Flask(__name__)
+app.json = NumpyJSONProvider(app)
 
 MARKER_SIZE=0.036
 MARKER_SPACING=0.005
@@ -56,8 +62,9 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 LATEST_IMAGE_PATH = os.path.join(UPLOAD_FOLDER, "latest.jpg")
-instructions = []
-counter = 0
+SESSIONS_FOLDER = os.path.join(BASE_DIR, 'sessions')
+#the replays and tests point this somewhere else, so they don't write into the live history
+HISTORY_FOLDER = os.environ.get("ROBOTIC_ARM_HISTORY_DIR", os.path.join(BASE_DIR, 'history'))
 ser = None
 current_port = None
 
@@ -69,6 +76,25 @@ current_gripper_position_in_arm, _ = get_gripper_coords_and_cam_rotation_from_ar
 detected_boxes = None
 latest_img = None
 server_ip = None
+recorder = SessionRecorder()
+#the board resets when the port is reopened, so it has to be activated again
+#only the banner counts, "activate" sent before setup() finished would be lost
+connection = SerialConnection(ready_patterns=[FIRMWARE_READY_BANNER], on_ready=lambda: send_serial_command(b"activate\n"))
+#the pooled ports stay open until the server exits
+atexit.register(connection.close_all)
+camera_stream = CameraStream(lambda frame: process_stream_frame(frame))
+reachability_map = ReachabilityMap.load_or_build()
+ik_cache = IKCache()
+history = HistoryStore(HISTORY_FOLDER)
+arm_transform = ArmTransformEstimator()
+programs = MotionProgramRunner(lambda angles: apply_world_angles(angles), lambda angle: set_gripper(angle),
+                               lambda: world_angles)
+#handlers that change the arm state or talk to the arm run one at a time, also against the program runner
+#and the stream worker, the owner process of the production server runs every connection on its own thread
+state_lock = threading.RLock()
+#the camera upload stays open for the whole stream, its frames take the lock one by one instead
+unlocked_endpoints = ["receive_image_stream"]
+unrecorded_endpoints = ["/api/serial_read", "/api/cam_data", "/api/status", "/api/record", "/api/stream", "/api/ik_cache", "/api/history"]
 
 class Servo:
     def __init__(self, servo_id, name, min_angle, max_angle, initial_angle):
@@ -94,9 +120,23 @@ servos = [Servo(0, "Servo Base", 0, 180, 30),
           Servo(4, "Servo Head Joint", 0, 180, 6), 
           Servo(5, "Servo Gripper", 70, 160, 160)]
 
+def with_state_lock(func):
+    @functools.wraps(func)
+    def locked(*args, **kwargs):
+        with state_lock:
+            return func(*args, **kwargs)
+    return locked
+
+@with_state_lock
 def move_to_position(target_coords, is_in_world_frame = True):
     global current_gripper_position_in_world, current_gripper_position_in_arm, translation, system_angle, world_angles
     target_coords = np.array(target_coords)
+    #reject targets out of reach before touching any state, the optimizer would just return its best wrong answer
+    if not is_in_world_frame:
+        reachability_map.check(target_coords)
+    elif translation is not None:
+        reachability_map.check(transform_world_to_arm_coords(target_coords, system_angle, translation))
+    
     if(is_in_world_frame):
         current_gripper_position_in_world = target_coords
         if(translation is not None):
@@ -109,13 +149,63 @@ def move_to_position(target_coords, is_in_world_frame = True):
             current_gripper_position_in_world = transform_arm_to_world_coords(current_gripper_position_in_arm, system_angle, translation)
     
     print("World angles before: ", world_angles)
-    world_angles = get_move_angles(target_coords, translation, system_angle, world_angles, is_in_world_frame)
+    world_angles = ik_cache.get_move_angles(target_coords, translation, system_angle, world_angles, is_in_world_frame)
     print("World angles after: ", world_angles)
     servo_angles = world_to_servo_angles(world_angles)
     if ser and ser.is_open:
         command = f"P{':'.join(map(str, servo_angles))}\n"
         print(command)
-        ser.write(command.encode())
+        send_serial_command(command)
+
+@with_state_lock
+def apply_world_angles(angles, only_if_changed=False):
+    #for angles that are already solved, updates the state and sends them to the arm
+    global current_gripper_position_in_world, current_gripper_position_in_arm, world_angles
+    previous_servo_angles = world_to_servo_angles(world_angles)
+    world_angles = JointAngles(angles)
+    servo_angles = world_to_servo_angles(world_angles)
+    
+    current_gripper_position_in_arm, _ = get_gripper_coords_and_cam_rotation_from_arm(world_angles)
+    if(translation is not None):
+        current_gripper_position_in_world = transform_arm_to_world_coords(current_gripper_position_in_arm, system_angle, translation)
+    
+    if only_if_changed and list(servo_angles) == list(previous_servo_angles):
+        return servo_angles
+    if ser and ser.is_open:
+        command = f"P{':'.join(map(str, servo_angles))}\n"
+        send_serial_command(command)
+    return servo_angles
+
+@with_state_lock
+def set_gripper(angle):
+    if ser and ser.is_open:
+        send_serial_command(f"S{GRIPPER_SERVO_ID}:{angle:03d}\n")
+
+def get_unreachable_response(error, is_in_world_frame=True):
+    nearest = error.nearest_in_arm
+    if is_in_world_frame and translation is not None:
+        nearest = transform_arm_to_world_coords(nearest, system_angle, translation)
+    return jsonify({'success': False, 'error': str(error), 'suggestion': nearest.tolist()})
+
+def respond(data):
+    #machine clients can ask for msgpack or the fixed layout state instead of JSON
+    mimetype = request.accept_mimetypes.best_match(get_response_mimetypes(), default=JSON_MIMETYPE)
+    if mimetype == MSGPACK_MIMETYPE:
+        return Response(encode_msgpack(data), mimetype=MSGPACK_MIMETYPE)
+    if mimetype == STATE_MIMETYPE:
+        image_bytes = base64.b64decode(latest_img) if request.args.get('image') and latest_img is not None else None
+        state = encode_state_struct(current_gripper_position_in_world, current_gripper_position_in_arm,
+                                    world_to_servo_angles(world_angles), detected_boxes or [], image_bytes)
+        return Response(state, mimetype=STATE_MIMETYPE)
+    return jsonify(data)
+
+@with_state_lock
+def send_serial_command(command):
+    if isinstance(command, str):
+        command = command.encode()
+    ser.write(command)
+    recorder.record(SERIAL_OUT, command)
+    history.record_command(command)
         
 def get_local_ip():
     global server_ip
@@ -130,10 +220,27 @@ def get_local_ip():
     print("Server ip: ", server_ip)
     return server_ip
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if request.method != 'GET' and request.endpoint not in unlocked_endpoints:
+        state_lock.acquire()
+        g.holds_state_lock = True
+
+@app.teardown_request
+def release_state_lock(exception):
+    if g.pop('holds_state_lock', False):
+        state_lock.release()
+
+@app.after_request
+def record_command(response):
+    if recorder.is_recording and request.path.startswith('/api/') and not any(request.path.startswith(path) for path in unrecorded_endpoints):
+        recorder.record_command(request.method, request.path, request.get_json(silent=True),
+                                time.perf_counter() - g.request_start, g.request_start)
+    return response
+
 @app.route('/get_position', methods=['POST'])
 def receive_image():
-    global current_gripper_position_in_world, current_gripper_position_in_arm, detected_boxes, translation, system_angle, latest_img
-    
     if 'imageFile' not in request.files:
         print("FILES:", request.files)
         return jsonify({"error": "No file part"}), 400
@@ -141,25 +248,57 @@ def receive_image():
     file = request.files['imageFile']
     file_bytes = file.read()
     print("Received:", len(file_bytes), "bytes")
+    recorder.record(FRAME, file_bytes, g.request_start)
 
-    img = decode_image(file_bytes)
-    cv2.imwrite(LATEST_IMAGE_PATH, img)
+    if not process_frame(file_bytes):
+        return jsonify({"error": "No aruco board"}), 400
     
-    _, camera_position, coordinate_systems_angle, R, rvec, tvec = get_camera_position(img, get_marker_positions(MARKER_SIZE, MARKER_SPACING), MARKER_SIZE)
+    return jsonify({"message": "OK"}), 200
+
+@app.route('/upload_stream', methods=['POST'])
+def receive_image_stream():
+    #the camera keeps this request open and writes one JPEG after another into it
+    camera_stream.start()
+    camera_stream.feed(iter(lambda: request.stream.read(STREAM_CHUNK_SIZE), b""))
+    return jsonify({"message": "Stream ended"}), 200
+
+def process_stream_frame(file_bytes):
+    recorder.record(FRAME, file_bytes)
+    if not process_frame(file_bytes):
+        print("No aruco board in streamed frame")
+
+@with_state_lock
+def process_frame(file_bytes):
+    global current_gripper_position_in_world, current_gripper_position_in_arm, detected_boxes, translation, system_angle, latest_img
+
+    img, reduced_img = decode_image_pyramid(file_bytes)
+    with open(LATEST_IMAGE_PATH, "wb") as f:
+        f.write(file_bytes)
+    
+    _, camera_position, coordinate_systems_angle, R, rvec, tvec, reprojection_error = get_camera_position(img, get_marker_positions(MARKER_SIZE, MARKER_SPACING), MARKER_SIZE, reduced_img)
     if(camera_position is None):
-        return jsonify({"error": "No aruco board"}), 400
+        return False
 
     print("Coordinate systems angle: ", np.degrees(coordinate_systems_angle))
-    current_gripper_position_in_world = conv_camera_coords_to_gripper_coords(camera_position, world_angles, coordinate_systems_angle)
+    gripper_position_in_world = conv_camera_coords_to_gripper_coords(camera_position, world_angles, coordinate_systems_angle)
     arm_angle = np.arctan2(current_gripper_position_in_arm[1], current_gripper_position_in_arm[0])
     print("Arm angle: ", np.degrees(arm_angle))
-    system_angle = coordinate_systems_angle-arm_angle
+    frame_system_angle = coordinate_systems_angle-arm_angle
     
-    translation = get_translation(current_gripper_position_in_world, current_gripper_position_in_arm, system_angle)
+    frame_translation = get_translation(gripper_position_in_world, current_gripper_position_in_arm, frame_system_angle)
+    history.record_pose(camera_position, coordinate_systems_angle, frame_system_angle, frame_translation,
+                        gripper_position_in_world, reprojection_error)
+    #a single frame is noisy, the moves use the transform fused over all frames since connecting
+    if not arm_transform.update(gripper_position_in_world, current_gripper_position_in_arm, frame_system_angle, reprojection_error):
+        print("Arm transform of this frame rejected as an outlier")
+    translation, system_angle = arm_transform.get_transform()
+    current_gripper_position_in_world = transform_arm_to_world_coords(current_gripper_position_in_arm, system_angle, translation)
+    ik_cache.set_calibration(translation, system_angle)
     
     camera_matrix, dist_coeffs = get_camera_matrix_and_dist_coeffs()
     
     detected_boxes, overlay_img = get_box_coordinates(img, camera_position, R, camera_matrix, dist_coeffs, rvec, tvec)
+    history.record_boxes(detected_boxes)
     
     _, buffer = cv2.imencode(".jpg", overlay_img)
 
@@ -167,8 +306,7 @@ def receive_image():
     
     print(detected_boxes)
     latest_img = base64.b64encode(image_bytes).decode('utf-8')
-    
-    return jsonify({"message": "OK"}), 200
+    return True
 
 def get_available_ports():
     ports = serial.tools.list_ports.comports()
@@ -187,7 +325,7 @@ def get_image():
     
     if ser and ser.is_open:
         command = f"take_photo:{get_local_ip()}\n"
-        ser.write(command.encode())
+        send_serial_command(command)
     
     return jsonify({'success': True})
 
@@ -212,12 +350,20 @@ def get_boxes():
         #TODO maybe handle empty boxes and no pos?
         print("Grip is world: ", current_gripper_position_in_world)
         print("Detected boxes: ", detected_boxes)
-        return jsonify({'success': True, 
+        return respond({'success': True, 
                         'image': latest_img,
-                        'worldCoords': current_gripper_position_in_world.tolist(),
-                        'boxes': [box.to_dict() for box in detected_boxes]})
+                        'worldCoords': current_gripper_position_in_world,
+                        'boxes': detected_boxes})
     return jsonify({'success': False, 'image': None, 'worldCoords': None, 'boxes': None})
 
+@app.route('/api/state', methods=['GET'])
+def get_state():
+    return respond({'success': True,
+                    'worldCoords': current_gripper_position_in_world,
+                    'armCoords': current_gripper_position_in_arm,
+                    'angles': world_to_servo_angles(world_angles),
+                    'boxes': detected_boxes or []})
+
 
 @app.route('/api/send_position', methods=['POST'])
 def set_world_position():
@@ -230,8 +376,37 @@ def set_world_position():
         
         move_to_position(coords, is_in_world_frame)
         other_frame_coords = current_gripper_position_in_arm if is_in_world_frame else current_gripper_position_in_world
-        servo_angles = [int(x) for x in world_to_servo_angles(world_angles)]
-        return jsonify({'success': True, 'otherFrameCoords': other_frame_coords.tolist(), 'angles': servo_angles})
+        return respond({'success': True, 'otherFrameCoords': other_frame_coords, 'angles': world_to_servo_angles(world_angles)})
+    except UnreachableTargetError as e:
+        print(str(e))
+        return get_unreachable_response(e, is_in_world_frame)
+    except Exception as e:
+        print(str(e))
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/jog', methods=['POST'])
+def jog():
+    try:
+        data = request.json
+        is_in_world_frame = data.get('isWorldFrame', False)
+        if data.get('velocity') is not None:
+            delta = np.array(data.get('velocity'), dtype=float) * float(data.get('dt', 0.02))
+        else:
+            delta = np.array(data.get('delta'), dtype=float)
+        
+        if is_in_world_frame:
+            if translation is None:
+                return jsonify({'success': False, 'error': 'Arm position in world is unknown'})
+            #only the direction changes between the frames
+            delta = get_rotation_matrix(system_angle).T @ delta
+        
+        #servos only take whole degrees, no point in resending the same command
+        servo_angles = apply_world_angles(get_jog_angles(world_angles.values, delta), only_if_changed=True)
+        
+        return respond({'success': True,
+                        'worldFrameCoords': current_gripper_position_in_world,
+                        'armFrameCoords': current_gripper_position_in_arm,
+                        'angles': servo_angles})
     except Exception as e:
         print(str(e))
         return jsonify({'success': False, 'error': str(e)})
@@ -251,11 +426,60 @@ def grab_box():
                         'armFrameCoords': current_gripper_position_in_arm,
                         'worldFrameCoords': current_gripper_position_in_world,
                         'angles': servo_angles})
+    except UnreachableTargetError as e:
+        print(str(e))
+        return get_unreachable_response(e)
     except Exception as e:
         print(str(e))
         return jsonify({'success': False, 'error': str(e)})
 
 
+@app.route('/api/schedule_boxes', methods=['POST'])
+def schedule_boxes():
+    try:
+        if not detected_boxes:
+            return jsonify({'success': False, 'error': 'No detected boxes'})
+        if translation is None:
+            return jsonify({'success': False, 'error': 'Arm position in world is unknown'})
+
+        data = request.json or {}
+        execute = data.get('execute', False)
+
+        grab_points = np.array([box.grab_point for box in detected_boxes], dtype=float)
+        #world to arm frame for all boxes at once, same as transform_world_to_arm_coords
+        grab_points_in_arm = (grab_points - translation) @ get_rotation_matrix(system_angle)
+        reachable = np.array([reachability_map.is_reachable(p) for p in grab_points_in_arm], dtype=bool)
+        if reachable.any():
+            angles, errors = get_move_angles_refined(grab_points_in_arm[reachable], world_angles.values)
+            #a box the optimizer can't get within tolerance of isn't picked either
+            reachable[np.flatnonzero(reachable)[errors > IK_TOLERANCE]] = False
+            angles = angles[errors <= IK_TOLERANCE]
+        else:
+            angles = np.empty((0, 5))
+        reachable_boxes = [box for box, is_reachable in zip(detected_boxes, reachable) if is_reachable]
+        order, angles, move_costs, total_time = schedule_picks(grab_points_in_arm[reachable], world_angles.values, angles)
+        box_ids = [int(reachable_boxes[i].id) for i in order]
+        print("Pick order: ", box_ids)
+
+        program_id = None
+        if execute and len(order) > 0:
+            #the program runner moves through the scheduled angles in the background, the request returns right away
+            targets_in_arm = grab_points_in_arm[reachable]
+            steps = [{"type": "move", "target": np.array(reachable_boxes[i].grab_point, dtype=float), "isWorldFrame": True,
+                      "targetInArm": targets_in_arm[i], "angles": angles[i], "box_id": int(reachable_boxes[i].id)}
+                     for i in order]
+            program_id = programs.submit(steps).id
+
+        return jsonify({'success': True,
+                        'order': box_ids,
+                        'unreachable': [int(box.id) for box, is_reachable in zip(detected_boxes, reachable) if not is_reachable],
+                        'moveCosts': move_costs.tolist(),
+                        'estimatedTime': total_time,
+                        'executed': bool(execute),
+                        'programId': program_id})
+    except Exception as e:
+        print(str(e))
+        return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/status', methods=['GET'])
 def status():
@@ -267,12 +491,50 @@ def status():
         'port': current_port if connected else None
     })
     
+@app.route('/api/ik_cache', methods=['GET', 'DELETE'])
+def ik_cache_stats():
+    if request.method == 'DELETE':
+        ik_cache.clear()
+    return jsonify({'success': True, **ik_cache.get_stats()})
+
+@app.route('/api/history/<stream>', methods=['GET'])
+def get_history(stream):
+    if stream not in STREAM_DTYPES:
+        return jsonify({'success': False, 'error': f'Unknown stream {stream}'}), 404
+    start = request.args.get('start', 0.0, type=float)
+    end = request.args.get('end', np.inf, type=float)
+    slices = history.query(stream, start, end)
+    count = sum(len(records) for records in slices)
+    
+    if request.args.get('format') == 'raw':
+        #the records go out straight from the mapped segments, the dtype header says how to read them
+        return Response((memoryview(np.ascontiguousarray(records)).cast("B") for records in slices),
+                        mimetype='application/octet-stream',
+                        headers={'X-Record-Dtype': json.dumps(STREAM_DTYPES[stream].descr), 'X-Record-Count': str(count)})
+    records = np.concatenate(slices) if slices else np.zeros(0, dtype=STREAM_DTYPES[stream])
+    columns = {name: records[name] for name in records.dtype.names}
+    if 'command' in columns:
+        columns['command'] = [command.decode() for command in columns['command']]
+    return jsonify({'success': True, 'count': count, **columns})
+
+@app.route('/api/calibration', methods=['GET', 'DELETE'])
+def calibration():
+    global translation, system_angle
+    
+    if request.method == 'DELETE':
+        arm_transform.reset()
+        translation, system_angle = arm_transform.get_transform()
+        ik_cache.set_calibration(translation, system_angle)
+    return jsonify({'success': True, **arm_transform.to_dict()})
+
 @app.route('/api/connect', methods=['POST'])
 def connect():
     global ser, current_port, current_gripper_position_in_arm, system_angle, translation, current_gripper_position_in_world, detected_boxes, latest_img, server_ip
     
     translation = None
     system_angle = None
+    arm_transform.reset()
+    ik_cache.set_calibration(translation, system_angle)
     world_angles = get_initial_angles()
     current_gripper_position_in_world = np.zeros(3)
     current_gripper_position_in_arm, _ = get_gripper_coords_and_cam_rotation_from_arm(world_angles)
@@ -283,23 +545,16 @@ def connect():
     try:
         data = request.json
         port = data.get('port')
-        baudrate = 9600
-        
-        if ser and ser.is_open:
-            ser.close()
         
-        ser = serial.Serial(port, baudrate, timeout=1)
+        reused = connection.open(port)
+        ser = connection
         current_port = port
-        time.sleep(2)
+        print(f"Port {port} ready after {connection.time_to_ready:.2f} s", "(reused)" if reused else "")
         
-        # ser.reset_input_buffer()
-        # ser.reset_output_buffer()
+        send_serial_command(b"activate\n")
         
-        time.sleep(2)
-        
-        ser.write(b"activate\n")
-        
-        return jsonify({'success': True, 'message': f'Connected to {port}', 'armPosition': current_gripper_position_in_arm.tolist()})
+        return jsonify({'success': True, 'message': f'Connected to {port}', 'armPosition': current_gripper_position_in_arm.tolist(),
+                        'timeToReady': connection.time_to_ready})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -308,11 +563,14 @@ def disconnect():
     global ser, current_port
     
     try:
-        if ser and ser.is_open:
-            ser.close()
+        #{"release": true} closes the port for other programs, otherwise it stays open in the pool
+        release = bool((request.get_json(silent=True) or {}).get('release', False))
+        #also stops a reconnect that is in progress
+        if ser:
+            ser.close(release=release)
         current_port = None
         
-        return jsonify({'success': True, 'message': 'Disconnected'})
+        return jsonify({'success': True, 'message': 'Disconnected and released the port' if release else 'Disconnected'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -330,7 +588,7 @@ def control_servo():
         
         # format: "S<id>:<angle>\n"
         command = f"S{servo_id}:{angle:03d}\n"
-        ser.write(command.encode())
+        send_serial_command(command)
         
         if(servo_id < 5):
             servo_angles_pattern = np.zeros(5)
@@ -343,9 +601,9 @@ def control_servo():
             if(translation is not None):
                 current_gripper_position_in_world = transform_arm_to_world_coords(current_gripper_position_in_arm, system_angle, translation)
         
-        return jsonify({'success': True, 
-                        'worldFrameCoords': current_gripper_position_in_world.tolist(),
-                        'armFrameCoords': current_gripper_position_in_arm.tolist()})
+        return respond({'success': True, 
+                        'worldFrameCoords': current_gripper_position_in_world,
+                        'armFrameCoords': current_gripper_position_in_arm})
     except Exception as e:
         print(str(e))
         return jsonify({'success': False, 'error': str(e)})
@@ -365,6 +623,7 @@ def serial_read():
                 line = ser.readline().decode('utf-8').strip()
                 if line:
                     lines.append(line)
+                    recorder.record(SERIAL_IN, line)
             except:
                 pass
                         
@@ -391,7 +650,64 @@ def serial_read():
         return jsonify({'success': True, 'data': lines})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
+@app.route('/api/record/start', methods=['POST'])
+def start_recording():
+    try:
+        data = request.get_json(silent=True) or {}
+        path = data.get('path') or os.path.join(SESSIONS_FOLDER, time.strftime("%Y%m%d_%H%M%S") + ".ras")
+        recorder.start(path)
+        return jsonify({'success': True, 'path': path})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/record/stop', methods=['POST'])
+def stop_recording():
+    path = recorder.stop()
+    return jsonify({'success': True, 'path': path})
+@app.route('/api/stream/start', methods=['POST'])
+def start_stream():
+    try:
+        data = request.json
+        url = data.get('url')
+        camera_stream.start(url)
+        return jsonify({'success': True, 'message': f'Streaming from {url}'})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/stream/stop', methods=['POST'])
+def stop_stream():
+    camera_stream.stop()
+    return jsonify({'success': True, 'message': 'Stream stopped'})
+
+@app.route('/api/stream/status', methods=['GET'])
+def stream_status():
+    return jsonify({'success': True, **camera_stream.get_stats()})
+@app.route('/api/program', methods=['POST'])
+def run_program():
+    try:
+        data = request.json
+        steps = parse_steps(data.get('steps'), detected_boxes, translation, system_angle, reachability_map)
+        program = programs.submit(steps)
+        return jsonify({'success': True, 'id': program.id})
+    except MotionProgramError as e:
+        return jsonify({'success': False, 'error': str(e)})
+    except Exception as e:
+        print(str(e))
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/program/<int:program_id>', methods=['GET'])
+def get_program(program_id):
+    if program_id not in programs.programs:
+        return jsonify({'success': False, 'error': f'No program {program_id}'}), 404
+    since = request.args.get('since', 0, type=int)
+    return jsonify({'success': True, **programs.programs[program_id].to_dict(since)})
+
+@app.route('/api/program/<int:program_id>/cancel', methods=['POST'])
+def cancel_program(program_id):
+    if program_id not in programs.programs:
+        return jsonify({'success': False, 'error': f'No program {program_id}'}), 404
+    program = programs.cancel(program_id)
+    return jsonify({'success': True, **program.to_dict()})
 
 if __name__ == '__main__':
-    app.json = NumpyJSONProvider(app)
     app.run(debug=True, host='0.0.0.0', port=5000, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,20 @@
+#gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+
+from src.serving import start_owner, stop_owner
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+#threads keep the long camera upload and the polling requests from blocking each other
+worker_class = "gthread"
+threads = int(os.environ.get("THREADS", 8))
+keepalive = 5
+accesslog = "-"
+
+def on_starting(server):
+    #before the workers fork, so they inherit the owner address from the environment
+    server.owner_process = start_owner()
+
+def on_exit(server):
+    stop_owner(server.owner_process)
@@ -0,0 +1,129 @@
+import argparse
+import io
+import json
+import tempfile
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+
+import flask_app
+from src.history import HistoryStore
+from src.session_recording import read_session, KIND_NAMES, FRAME, SERIAL_OUT, SERIAL_IN, COMMAND
+
+#these need real hardware, the replay serial port is installed instead
+HARDWARE_ENDPOINTS = ["/api/connect", "/api/disconnect", "/api/ports"]
+
+class ReplaySerial:
+    """Stands in for serial.Serial, serving the recorded inbound lines and collecting writes."""
+    def __init__(self):
+        self.is_open = True
+        self.written = []
+        self._lines = deque()
+
+    def feed(self, line):
+        self._lines.append(line + b"\n")
+
+    @property
+    def in_waiting(self):
+        return sum(len(line) for line in self._lines)
+
+    def readline(self):
+        return self._lines.popleft() if self._lines else b""
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+    def close(self, release=False):
+        self.is_open = False
+
+def replay(path, realtime=False):
+    with tempfile.TemporaryDirectory() as history_dir:
+        #the replayed poses and commands go into a throwaway history, not the one of the live server
+        live_history = flask_app.history
+        flask_app.history = HistoryStore(history_dir)
+        try:
+            return replay_records(path, realtime)
+        finally:
+            flask_app.history.close()
+            flask_app.history = live_history
+
+def replay_records(path, realtime):
+    client = flask_app.app.test_client()
+    replay_serial = ReplaySerial()
+    flask_app.ser = replay_serial
+    flask_app.current_port = "replay"
+
+    latencies = defaultdict(list)
+    recorded_durations = defaultdict(list)
+    expected_serial_out = 0
+    start = time.perf_counter()
+
+    for record in read_session(path):
+        if realtime:
+            delay = record.timestamp - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        if record.kind == SERIAL_OUT:
+            expected_serial_out += 1
+            continue
+
+        t0 = time.perf_counter()
+        if record.kind == FRAME:
+            name = "/get_position"
+            client.post(name, data={'imageFile': (io.BytesIO(record.payload), 'frame.jpg')},
+                        content_type='multipart/form-data')
+        elif record.kind == SERIAL_IN:
+            name = "/api/serial_read"
+            replay_serial.feed(record.payload)
+            client.get(name)
+        elif record.kind == COMMAND:
+            command = json.loads(record.payload)
+            name = command["path"]
+            if name in HARDWARE_ENDPOINTS:
+                continue
+            recorded_durations[name].append(command["duration"])
+            client.open(name, method=command["method"], json=command["body"])
+        else:
+            continue
+        latencies[name].append(time.perf_counter() - t0)
+
+    total_time = time.perf_counter() - start
+    return latencies, recorded_durations, total_time, len(replay_serial.written), expected_serial_out
+
+def print_report(latencies, recorded_durations, total_time, serial_out, expected_serial_out):
+    total_requests = sum(len(v) for v in latencies.values())
+    print(f"Replayed {total_requests} requests in {total_time:.3f} s ({total_requests / max(total_time, 1e-9):.1f} req/s)")
+    print(f"Serial commands: {serial_out} sent, {expected_serial_out} in the recording")
+    print(f"{'endpoint':<24}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'recorded p50':>14}")
+    for name, values in sorted(latencies.items()):
+        values = np.array(values) * 1000
+        recorded = np.median(recorded_durations[name]) * 1000 if recorded_durations[name] else float("nan")
+        print(f"{name:<24}{len(values):>7}{np.percentile(values, 50):>10.2f}{np.percentile(values, 95):>10.2f}"
+              f"{values.max():>10.2f}{recorded:>14.2f}")
+
+def print_summary(path):
+    counts = defaultdict(int)
+    sizes = defaultdict(int)
+    duration = 0
+    for record in read_session(path):
+        counts[record.kind] += 1
+        sizes[record.kind] += len(record.payload)
+        duration = record.timestamp
+    print(f"Session {path}: {duration:.1f} s")
+    for kind, count in counts.items():
+        print(f"  {KIND_NAMES[kind]:<12}{count:>7} records {sizes[kind] / 1024:>10.1f} KiB")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a recorded session through the server without hardware")
+    parser.add_argument("session", help="path to a .ras session recording")
+    parser.add_argument("--realtime", action="store_true", help="keep the original pacing instead of replaying as fast as possible")
+    parser.add_argument("--summary", action="store_true", help="only print what the recording contains")
+    args = parser.parse_args()
+
+    if args.summary:
+        print_summary(args.session)
+    else:
+        print_report(*replay(args.session, args.realtime))
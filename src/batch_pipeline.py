@@ -0,0 +1,181 @@
+"""Runs the board pose and box detection over archived frames, without the server.
+
+Run from the repository root:
+    python -m src.batch_pipeline uploads/ "sessions/frames/*.jpg" --output results.jsonl
+    python -m src.batch_pipeline uploads/ --output results.csv --overlay-dir overlays/
+
+Every worker process loads the model and the calibration once and the frames are
+streamed through the pool, so the memory use doesn't grow with the number of images.
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+from src.camera_utils import decode_image_pyramid, get_camera_position, get_marker_positions, get_camera_matrix_and_dist_coeffs
+
+MARKER_SIZE = 0.036
+MARKER_SPACING = 0.005
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+STAGES = ["read", "decode", "pose", "boxes", "total"]
+CSV_FIELDS = (["path", "success", "error", "camera_x", "camera_y", "camera_z", "board_angle", "reprojection_error",
+               "box_count", "boxes"] + [f"{stage}_ms" for stage in STAGES])
+
+_worker = {}
+
+def iter_image_paths(inputs):
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        for path in sorted(glob.iglob(pattern)):
+            if path.lower().endswith(IMAGE_EXTENSIONS):
+                yield path
+
+def init_worker(overlay_dir, detect_boxes):
+    #the pipeline prints as it goes, keep that out of the results on stdout
+    sys.stdout = sys.stderr
+    #one thread per process, the pool already uses every core
+    cv2.setNumThreads(1)
+    try:
+        import torch
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+    _worker["overlay_dir"] = overlay_dir
+    _worker["detect_boxes"] = detect_boxes
+    _worker["marker_positions"] = get_marker_positions(MARKER_SIZE, MARKER_SPACING)
+    if detect_boxes:
+        from src.box_detection import get_model
+        #a pool whose initializer raises restarts its workers forever, the images report the error instead
+        try:
+            get_model()
+        except Exception as e:
+            print("Could not load the model:", e)
+
+def process_image(path):
+    overlay_dir = _worker["overlay_dir"]
+    result = {"path": path, "success": False, "error": None, "timings": {}}
+    timings = result["timings"]
+    start = last = time.perf_counter()
+
+    def lap(stage):
+        nonlocal last
+        now = time.perf_counter()
+        timings[stage] = (now - last) * 1000
+        last = now
+
+    try:
+        with open(path, "rb") as f:
+            file_bytes = f.read()
+        lap("read")
+        img, reduced_img = decode_image_pyramid(file_bytes)
+        if img is None:
+            raise ValueError("Not a readable image")
+        lap("decode")
+
+        _, camera_position, board_angle, R, rvec, tvec, reprojection_error = get_camera_position(
+            img, _worker["marker_positions"], MARKER_SIZE, reduced_img, draw_overlay=False)
+        lap("pose")
+        if camera_position is None:
+            raise ValueError("No aruco board")
+        result["cameraPosition"] = camera_position.tolist()
+        result["boardAngle"] = float(board_angle)
+        result["reprojectionError"] = float(reprojection_error)
+
+        if _worker["detect_boxes"]:
+            from src.box_detection import get_box_coordinates
+            camera_matrix, dist_coeffs = get_camera_matrix_and_dist_coeffs()
+            boxes, overlay_img = get_box_coordinates(img, camera_position, R, camera_matrix, dist_coeffs, rvec, tvec,
+                                                     draw_overlay=overlay_dir is not None)
+            result["boxes"] = [box.to_dict() for box in boxes]
+            lap("boxes")
+            if overlay_img is not None:
+                cv2.imwrite(os.path.join(overlay_dir, os.path.basename(path)), overlay_img)
+        result["success"] = True
+    except Exception as e:
+        result["error"] = str(e)
+    timings["total"] = (time.perf_counter() - start) * 1000
+    return result
+
+def to_json_value(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    raise TypeError(f"Can't serialize {type(obj).__name__}")
+
+def get_csv_row(result):
+    camera_position = result.get("cameraPosition") or [None] * 3
+    row = {
+        "path": result["path"],
+        "success": result["success"],
+        "error": result["error"],
+        "camera_x": camera_position[0],
+        "camera_y": camera_position[1],
+        "camera_z": camera_position[2],
+        "board_angle": result.get("boardAngle"),
+        "reprojection_error": result.get("reprojectionError"),
+        "box_count": len(result.get("boxes", [])),
+        "boxes": json.dumps(result.get("boxes", []), default=to_json_value),
+    }
+    for stage in STAGES:
+        row[f"{stage}_ms"] = result["timings"].get(stage)
+    return row
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="image directories or glob patterns")
+    parser.add_argument("--output", default="-", help=".csv or .jsonl file, JSON lines on stdout by default")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, all cores by default")
+    parser.add_argument("--chunksize", type=int, default=4)
+    parser.add_argument("--overlay-dir", default=None, help="also save the detection overlays here")
+    parser.add_argument("--pose-only", action="store_true", help="skip the box detection")
+    args = parser.parse_args()
+
+    if not args.pose_only:
+        #imported here so that --pose-only runs without ultralytics, and fails before any work otherwise
+        import src.box_detection
+    if args.overlay_dir is not None:
+        os.makedirs(args.overlay_dir, exist_ok=True)
+    is_csv = args.output.lower().endswith(".csv")
+    out = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS) if is_csv else None
+    if writer is not None:
+        writer.writeheader()
+
+    count = failed = 0
+    totals = dict.fromkeys(STAGES, 0.0)
+    counts = dict.fromkeys(STAGES, 0)
+    start = time.perf_counter()
+    with Pool(args.workers, initializer=init_worker, initargs=(args.overlay_dir, not args.pose_only)) as pool:
+        #results are written as they come in and in input order
+        for result in pool.imap(process_image, iter_image_paths(args.inputs), chunksize=args.chunksize):
+            if writer is not None:
+                writer.writerow(get_csv_row(result))
+            else:
+                out.write(json.dumps(result, default=to_json_value) + "\n")
+            count += 1
+            failed += not result["success"]
+            for stage, ms in result["timings"].items():
+                totals[stage] += ms
+                counts[stage] += 1
+    elapsed = time.perf_counter() - start
+    if out is not sys.stdout:
+        out.close()
+
+    print(f"{count} images, {failed} failed, {elapsed:.2f}s, {count / elapsed if elapsed else 0:.1f} images/s", file=sys.stderr)
+    if count:
+        print("Mean per image: " + ", ".join(f"{stage} {totals[stage] / counts[stage]:.1f}ms" for stage in STAGES if counts[stage]),
+              file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
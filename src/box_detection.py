@@ -2,9 +2,12 @@ import cv2
 import numpy as np
 from ultralytics import YOLO
 import os
+import threading
 import cv2.aruco as aruco
 from dataclasses import dataclass, asdict
 
+from src.projection import FrameProjection
+
 BOX_CODE_SIZE = 0.03
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 MODEL_DIR = os.path.join(BASE_DIR, 'model/best.pt')
@@ -111,64 +114,33 @@ def detect_box_codes(img, boxes):
 def get_polygon_centroid(polygon):
     return np.mean(polygon, axis=0)
 
-def get_height_from_box_code(box_corners, camera_matrix, dist_coeffs, camera_position, R):
-    box_code_2d = undistort_points(box_corners, camera_matrix, dist_coeffs)
-    rays = get_world_rays_from_img_points(box_code_2d, camera_matrix, R)
-
-    d0 = rays[0]
-    d1 = rays[1]
-    #distance between the projections of the 2 qr code rays on the z plane
-    K_factor = np.linalg.norm(
-        d1 / d1[2] - d0 / d0[2]
-    )
-
-    h = camera_position[2] - BOX_CODE_SIZE / K_factor
-    return h
-    
-    
-def undistort_points(points, camera_matrix, dist_coeffs):
-    points_2d = np.array(points, dtype=np.float32).reshape(-1,1,2)
-    undistorted = cv2.undistortPoints(points_2d, camera_matrix, dist_coeffs, P=camera_matrix)
-    undistorted = undistorted.reshape(-1,2)
-    return undistorted
-
-def get_world_rays_from_img_points(points, camera_matrix, R):
-    rays = []
-    camera_matrix_inv = np.linalg.inv(camera_matrix)
-    for p in points:
-        p_h = np.array([p[0], p[1], 1.0])
-        ray_cam = camera_matrix_inv @ p_h
-        ray_cam /= np.linalg.norm(ray_cam)
-        ray = R.T @ ray_cam
-        rays.append(ray)
-
-    rays = np.array(rays)
-    return rays
+def get_heights_from_box_codes(projection, box_codes_corners):
+    #first two corners of every box code, (M,2,2)
+    box_codes_corners = np.asarray(box_codes_corners, dtype=np.float64)
+    rays = projection.get_rays(box_codes_corners[:, :2].reshape(-1, 2)).reshape(-1, 2, 3)
+    #distance between the projections of the 2 code corner rays on the z plane
+    rays_on_plane = rays / rays[:, :, 2:3]
+    K_factor = np.linalg.norm(rays_on_plane[:, 1] - rays_on_plane[:, 0], axis=1)
+    return projection.camera_position[2] - BOX_CODE_SIZE / K_factor
 
 def get_cuboid_info(top_side_world_points):
-    print("Top side world points:", top_side_world_points)
-    len1 = np.linalg.norm(top_side_world_points[0] - top_side_world_points[1])
-    len2 = np.linalg.norm(top_side_world_points[1] - top_side_world_points[2])
-    width, length, width_vec, length_vec = (None, None, None, None)
-    if len1 > len2:
-        length = len1
-        width = len2
-        length_vec = top_side_world_points[0] - top_side_world_points[1]
-        width_vec = top_side_world_points[2] - top_side_world_points[1]
-    else:
-        length = len2
-        width = len1
-        length_vec = top_side_world_points[2] - top_side_world_points[1]
-        width_vec = top_side_world_points[0] - top_side_world_points[1]
+    #(M,3,3), three top corners of every box with the middle one shared by both sides
+    p0, p1, p2 = top_side_world_points[:, 0], top_side_world_points[:, 1], top_side_world_points[:, 2]
+    side1 = p0 - p1
+    side2 = p2 - p1
+    len1 = np.linalg.norm(side1, axis=1)
+    len2 = np.linalg.norm(side2, axis=1)
+
+    first_longer = (len1 > len2)[:, None]
+    length_vec = np.where(first_longer, side1, side2)
+    width_vec = np.where(first_longer, side2, side1)
+    length = np.maximum(len1, len2)
+    width = np.minimum(len1, len2)
+
+    grab_point = p1 + 0.5 * width_vec + 0.5 * length_vec
+    grab_point[:, 2] -= p1[:, 2] * 0.7
+    print("Cuboid grab points:", grab_point)
 
-    print("Cuboid width vector:", width_vec)
-    print("Cuboid length vector:", length_vec)
-    
-    print("Cuboid width:", width)
-    print("Cuboid length:", length)
-    grab_point = top_side_world_points[1] + 0.5 * width_vec + 0.5 * length_vec - [0,0,top_side_world_points[1][2] * 0.7]
-    print("Cuboid grab point:", grab_point)
-    
     return grab_point, width, length
 
 def undistort_img(img, camera_matrix, dist_coeffs):
@@ -179,39 +151,26 @@ def undistort_img(img, camera_matrix, dist_coeffs):
     undistorted = cv2.undistort(img, camera_matrix, dist_coeffs, None, new_camera_matrix)
     return undistorted, new_camera_matrix
 
-def image_to_world_undistorted1(u, v, Z_known, K, rvec, tvec):
-    transform = np.array([
-        [0, 1,  0],
-        [1, 0,  0],
-        [0, 0, -1]
-    ])
-    
-    # pts = np.array([[[u, v]]], dtype=np.float32)
-    # pts_norm = cv2.undistortPoints(pts, K, dist_coeffs)
-    # ray_c = np.array([[pts_norm[0,0,0]],
-    #                 [pts_norm[0,0,1]],
-    #                 [1.0]])
-    ray_c = np.linalg.inv(K) @ np.array([[u], [v], [1.0]])
-
-    R, _ = cv2.Rodrigues(rvec)
-
-    ray_board = R.T @ ray_c
-    C_board = -R.T @ tvec
+_models = {}
+_model_lock = threading.Lock()
+#the ultralytics predictor keeps per call state, the request, stream and program threads can't share it unguarded
+_predict_lock = threading.Lock()
 
-    s = (Z_known - C_board[2, 0]) / ray_board[2, 0]
-    P_board = C_board + s * ray_board
-
-    P_board = transform @ P_board
-    
-    return P_board.flatten()
+def get_model(model_path=MODEL_DIR):
+    #loading the weights takes longer than a prediction, so every process loads them once
+    with _model_lock:
+        if model_path not in _models:
+            _models[model_path] = YOLO(model_path)
+        return _models[model_path]
 
-def get_box_coordinates(img, camera_position, R, camera_matrix, dist_coeffs, rvec, tvec):
-    model = YOLO(MODEL_DIR)
+def get_box_coordinates(img, camera_position, R, camera_matrix, dist_coeffs, rvec, tvec, draw_overlay=True):
+    model = get_model()
     img, new_camera_matrix = undistort_img(img, camera_matrix, dist_coeffs)
-    result = model.predict(source=img)[0]
+    with _predict_lock:
+        result = model.predict(source=img)[0]
     
     if(result.masks is None):
-        return []
+        return [], img if draw_overlay else None
 
     masks = result.masks.data.cpu().numpy()
     masks = rescale_masks(masks, img.shape)
@@ -222,7 +181,7 @@ def get_box_coordinates(img, camera_position, R, camera_matrix, dist_coeffs, rve
         
 
     polygons = get_polygons_from_masks(new_masks)
-    overlay = draw_masks_and_polygons(img, new_masks, polygons)
+    overlay = draw_masks_and_polygons(img, new_masks, polygons) if draw_overlay else None
     
     boxes = result.boxes.data.cpu().numpy()
     boxes_codes_info = detect_box_codes(img, boxes)
@@ -230,28 +189,37 @@ def get_box_coordinates(img, camera_position, R, camera_matrix, dist_coeffs, rve
 
     h, w = img.shape[:2]
     camera_center = np.array([w/2, h/2]) #TODO cam angle not 90
-    boxes_info = []
+    projection = FrameProjection(new_camera_matrix, rvec, tvec)
+    box_ids = []
+    top_side_points = []
+    box_codes_corners = []
     for i, polygon in enumerate(polygons):
         #we know that the furthest point from the camera center is the top of the box, and so are its 2 adjacent points
-        furthest_point = np.argmax([np.linalg.norm(p - camera_center) for p in polygon])
-        top_side_points = [polygon[(furthest_point-1)%len(polygon)], polygon[furthest_point], polygon[(furthest_point+1)%len(polygon)]]
+        furthest_point = np.argmax(np.linalg.norm(polygon - camera_center, axis=1))
+        n = len(polygon)
+        top_side = polygon[[(furthest_point-1)%n, furthest_point, (furthest_point+1)%n]]
         
-        for (x, y) in top_side_points:
-            cv2.circle(overlay, (int(x), int(y)), 5, (0, 255, 0), -1)
-        # cv2.imwrite("result.png", overlay)
+        if draw_overlay:
+            for (x, y) in top_side:
+                cv2.circle(overlay, (int(x), int(y)), 5, (0, 255, 0), -1)
         box_code_info = boxes_codes_info[i]
-        print(box_code_info)
         if box_code_info is None:
             continue
         
-        cuboid_height = get_height_from_box_code(box_code_info["corners"], new_camera_matrix, None, camera_position, R)
-        # cuboid_height = 0.05
-        print("Cuboid height:", cuboid_height)
-        print("Box id:", box_code_info["id"])
-
-        top_side_world_points = [image_to_world_undistorted1(p[0], p[1], -cuboid_height, new_camera_matrix, rvec, tvec) for p in top_side_points]
-            
-        grab_point, width, length = get_cuboid_info(top_side_world_points)
-        boxes_info.append(Box(box_code_info["id"], grab_point, width, length, cuboid_height))
+        box_ids.append(box_code_info["id"])
+        top_side_points.append(top_side)
+        box_codes_corners.append(box_code_info["corners"][:2])
+    
+    if len(box_ids) == 0:
+        return [], overlay
+    
+    #all boxes are back-projected together, every top corner at the height of its box
+    heights = get_heights_from_box_codes(projection, box_codes_corners)
+    print("Box ids:", box_ids, "heights:", heights)
+    top_side_world_points = projection.back_project(np.vstack(top_side_points), np.repeat(heights, 3)).reshape(-1, 3, 3)
+    
+    grab_points, widths, lengths = get_cuboid_info(top_side_world_points)
+    boxes_info = [Box(box_id, grab_point, width, length, height)
+                  for box_id, grab_point, width, length, height in zip(box_ids, grab_points, widths, lengths, heights)]
         
     return boxes_info, overlay
\ No newline at end of file
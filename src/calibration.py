@@ -0,0 +1,127 @@
+"""Recalibrates the camera intrinsics from a directory of board photos.
+
+Run from the repository root:
+    python -m src.calibration path/to/board_images
+
+Markers are detected on a process pool, views with a high reprojection error are dropped
+and the result is saved to src/cam_parameters/calibration.npz, which the server picks up on its next frame.
+"""
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from src.camera_utils import get_all_markers, get_marker_positions, CAM_PARAMETERS_DIR, CALIBRATION_PATH
+
+MARKER_SIZE = 0.036
+MARKER_SPACING = 0.005
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+#fewer markers than this don't constrain the distortion enough to be worth keeping
+MIN_MARKERS_PER_VIEW = 4
+MIN_VIEWS = 5
+#views are only rejected above both the absolute and the relative limit, so a good set isn't trimmed for nothing
+MIN_REJECT_ERROR = 0.5
+OUTLIER_FACTOR = 2.5
+
+def get_image_paths(image_dir):
+    paths = [path for path in glob.glob(os.path.join(image_dir, "*")) if path.lower().endswith(IMAGE_EXTENSIONS)]
+    return sorted(paths)
+
+def detect_view(path, marker_size=MARKER_SIZE, marker_spacing=MARKER_SPACING):
+    """Runs in a worker process, only the points travel back, not the image."""
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return path, None, None, None
+    marker_positions = get_marker_positions(marker_size, marker_spacing)
+    object_points, image_points = get_all_markers(img, marker_positions, marker_size)
+    if object_points is None or len(object_points) < MIN_MARKERS_PER_VIEW * 4:
+        return path, None, None, img.shape[::-1]
+    return path, object_points, image_points, img.shape[::-1]
+
+def detect_views(paths, workers=None, marker_size=MARKER_SIZE, marker_spacing=MARKER_SPACING):
+    chunksize = max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(detect_view, paths, [marker_size] * len(paths), [marker_spacing] * len(paths),
+                           chunksize=chunksize)
+        return list(results)
+
+def calibrate_views(object_points, image_points, image_size, min_reject_error=MIN_REJECT_ERROR,
+                    outlier_factor=OUTLIER_FACTOR, min_views=MIN_VIEWS):
+    """Calibrates and drops the worst views until every remaining one is within the limits.
+
+    Returns the camera matrix, the distortion coefficients, the overall RMS error,
+    the indices of the kept views and their reprojection errors.
+    """
+    kept = np.arange(len(object_points))
+    while True:
+        rms, camera_matrix, dist_coeffs, _, _, _, _, view_errors = cv2.calibrateCameraExtended(
+            [object_points[i] for i in kept], [image_points[i] for i in kept], image_size, None, None)
+        view_errors = view_errors.ravel()
+        limit = max(min_reject_error, outlier_factor * np.median(view_errors))
+        outliers = view_errors > limit
+        if not outliers.any() or len(kept) - np.count_nonzero(outliers) < min_views:
+            return camera_matrix, dist_coeffs, rms, kept, view_errors
+        kept = kept[~outliers]
+
+def save_calibration(camera_matrix, dist_coeffs, directory=CAM_PARAMETERS_DIR):
+    os.makedirs(directory, exist_ok=True)
+    #one file written under a temporary name first, so the server never loads a half written file
+    #or the camera matrix of one calibration with the distortion of another
+    path = os.path.join(directory, os.path.basename(CALIBRATION_PATH))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, camera_matrix=camera_matrix, dist_coeffs=dist_coeffs)
+    os.replace(tmp_path, path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image_dir")
+    parser.add_argument("--workers", type=int, default=None, help="detection processes, all cores by default")
+    parser.add_argument("--output", default=CAM_PARAMETERS_DIR)
+    parser.add_argument("--marker-size", type=float, default=MARKER_SIZE)
+    parser.add_argument("--marker-spacing", type=float, default=MARKER_SPACING)
+    parser.add_argument("--min-reject-error", type=float, default=MIN_REJECT_ERROR)
+    parser.add_argument("--outlier-factor", type=float, default=OUTLIER_FACTOR)
+    parser.add_argument("--dry-run", action="store_true", help="only print the result")
+    args = parser.parse_args()
+
+    paths = get_image_paths(args.image_dir)
+    if len(paths) == 0:
+        parser.error(f"no images in {args.image_dir}")
+
+    start = time.perf_counter()
+    views = detect_views(paths, args.workers, args.marker_size, args.marker_spacing)
+    detect_time = time.perf_counter() - start
+
+    usable = [view for view in views if view[1] is not None]
+    print(f"Detected markers in {len(usable)} of {len(paths)} images in {detect_time:.2f}s")
+    for path, _, _, _ in views:
+        if path not in {view[0] for view in usable}:
+            print(f"  skipped {os.path.basename(path)}")
+    if len(usable) < MIN_VIEWS:
+        raise SystemExit(f"Need at least {MIN_VIEWS} usable images")
+    image_sizes = {view[3] for view in usable}
+    if len(image_sizes) > 1:
+        raise SystemExit(f"Images have different sizes: {sorted(image_sizes)}")
+
+    start = time.perf_counter()
+    camera_matrix, dist_coeffs, rms, kept, view_errors = calibrate_views(
+        [view[1] for view in usable], [view[2] for view in usable], image_sizes.pop(),
+        args.min_reject_error, args.outlier_factor)
+    print(f"Calibrated on {len(kept)} views in {time.perf_counter() - start:.2f}s, RMS {rms:.3f}px")
+    for i in sorted(set(range(len(usable))) - set(kept)):
+        print(f"  rejected {os.path.basename(usable[i][0])}")
+    print("Worst view error: %.3fpx" % view_errors.max())
+    print("Camera matrix:\n", camera_matrix)
+    print("Distortion coefficients:", dist_coeffs.ravel())
+
+    if not args.dry_run:
+        save_calibration(camera_matrix, dist_coeffs, args.output)
+        print("Saved to", args.output)
+
+if __name__ == '__main__':
+    main()
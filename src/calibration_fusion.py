@@ -0,0 +1,123 @@
+import numpy as np
+
+from src.movement import get_translation
+
+#a frame with a reprojection error of e pixels gets the weight 1 / (e^2 + floor^2)
+REPROJECTION_ERROR_FLOOR = 0.1
+#older frames fade out, so a slow drift of the board is still followed
+DECAY = 0.95
+GATE_SIGMAS = 3
+#noise alone never gets a frame rejected below these
+MIN_ANGLE_GATE = np.radians(2)
+MIN_TRANSLATION_GATE = 0.01
+MIN_SAMPLES_FOR_GATING = 3
+#this many rejected frames in a row means the arm or the board was moved, start over from the latest frame
+MAX_CONSECUTIVE_REJECTIONS = 5
+
+def wrap_angle(angle):
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+class ArmTransformEstimator:
+    """Running estimate of the arm to world transform (system angle and translation) over all frames.
+
+    Every frame updates exponentially weighted sums in O(1), the angle as a circular mean.
+    Frames further than GATE_SIGMAS standard deviations from the estimate are rejected.
+    """
+    def __init__(self, decay=DECAY):
+        self.decay = decay
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.restarts = 0
+        self._clear_estimate()
+
+    def _clear_estimate(self):
+        self.weight_sum = 0.0
+        self.cos_sum = 0.0
+        self.sin_sum = 0.0
+        self.angle_var_sum = 0.0
+        self.translation = None
+        self.translation_var_sum = 0.0
+        self.estimate_samples = 0
+        self.consecutive_rejections = 0
+
+    @property
+    def system_angle(self):
+        if self.weight_sum == 0:
+            return None
+        return np.arctan2(self.sin_sum, self.cos_sum)
+
+    def get_angle_std(self):
+        return np.sqrt(self.angle_var_sum / self.weight_sum) if self.weight_sum else None
+
+    def get_translation_std(self):
+        return np.sqrt(self.translation_var_sum / self.weight_sum) if self.weight_sum else None
+
+    def get_transform(self):
+        return self.translation, self.system_angle
+
+    def is_outlier(self, system_angle, translation):
+        if self.estimate_samples < MIN_SAMPLES_FOR_GATING:
+            return False
+        angle_gate = max(MIN_ANGLE_GATE, GATE_SIGMAS * self.get_angle_std())
+        translation_gate = max(MIN_TRANSLATION_GATE, GATE_SIGMAS * self.get_translation_std())
+        return (abs(wrap_angle(system_angle - self.system_angle)) > angle_gate
+                or np.linalg.norm(translation - self.translation) > translation_gate)
+
+    def update(self, gripper_in_world, gripper_in_arm, system_angle, reprojection_error):
+        """Adds the transform measured on one frame, returns False when it was rejected as an outlier."""
+        self.samples += 1
+        gripper_in_world = np.asarray(gripper_in_world, dtype=float)
+        gripper_in_arm = np.asarray(gripper_in_arm, dtype=float)
+        #the translation is measured under the fused angle, otherwise the angle noise ends up in it too
+        reference_angle = self.system_angle if self.system_angle is not None else system_angle
+        translation = get_translation(gripper_in_world, gripper_in_arm, reference_angle)
+
+        if self.is_outlier(system_angle, translation):
+            self.consecutive_rejections += 1
+            if self.consecutive_rejections < MAX_CONSECUTIVE_REJECTIONS:
+                self.rejected += 1
+                return False
+            print("Arm transform moved, restarting the estimate")
+            self._clear_estimate()
+            self.restarts += 1
+            translation = get_translation(gripper_in_world, gripper_in_arm, system_angle)
+
+        w = 1 / (reprojection_error ** 2 + REPROJECTION_ERROR_FLOOR ** 2)
+        previous_angle = self.system_angle
+        previous_translation = self.translation
+
+        self.weight_sum = self.decay * self.weight_sum + w
+        self.cos_sum = self.decay * self.cos_sum + w * np.cos(system_angle)
+        self.sin_sum = self.decay * self.sin_sum + w * np.sin(system_angle)
+        if previous_angle is None:
+            self.translation = translation
+        else:
+            #weighted incremental variance, (x - old mean) * (x - new mean)
+            self.angle_var_sum = self.decay * self.angle_var_sum + w * (
+                wrap_angle(system_angle - previous_angle) * wrap_angle(system_angle - self.system_angle))
+            self.translation = previous_translation + (w / self.weight_sum) * (translation - previous_translation)
+            self.translation_var_sum = self.decay * self.translation_var_sum + w * float(
+                np.dot(translation - previous_translation, translation - self.translation))
+
+        self.accepted += 1
+        self.estimate_samples += 1
+        self.consecutive_rejections = 0
+        return True
+
+    def to_dict(self):
+        angle_std = self.get_angle_std()
+        return {
+            "systemAngle": self.system_angle,
+            "translation": self.translation,
+            "angleStdDeg": np.degrees(angle_std) if angle_std is not None else None,
+            "translationStd": self.get_translation_std(),
+            "samples": self.samples,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "consecutiveRejections": self.consecutive_rejections,
+            "restarts": self.restarts,
+        }
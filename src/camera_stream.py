@@ -0,0 +1,128 @@
+import threading
+import time
+import urllib.request
+
+STREAM_CHUNK_SIZE = 16 * 1024
+JPEG_START = b"\xff\xd8"
+JPEG_END = b"\xff\xd9"
+#a stream that never closes a frame shouldn't grow the buffer forever
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+
+def split_jpeg_stream(chunks):
+    """Yields complete JPEG images from a byte stream, skipping the MJPEG multipart headers in between."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            start = buffer.find(JPEG_START)
+            if start < 0:
+                #keep a trailing 0xff in case the start marker is split between chunks
+                del buffer[:-1]
+                break
+            end = buffer.find(JPEG_END, start + 2)
+            if end < 0:
+                del buffer[:start]
+                if len(buffer) > MAX_FRAME_SIZE:
+                    buffer.clear()
+                break
+            yield bytes(buffer[start:end + 2])
+            del buffer[:end + 2]
+
+class LatestFrameBuffer:
+    """Single slot frame buffer, a new frame replaces the one that wasn't processed yet."""
+    def __init__(self):
+        self._frame = None
+        self._condition = threading.Condition()
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        with self._condition:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self.received += 1
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        with self._condition:
+            if self._frame is None:
+                self._condition.wait(timeout)
+            frame, self._frame = self._frame, None
+            return frame
+
+class CameraStream:
+    """Pulls an MJPEG stream from the camera (or takes pushed chunks) and processes the freshest frame."""
+    def __init__(self, process_frame):
+        self.process_frame = process_frame
+        self.buffer = LatestFrameBuffer()
+        self.url = None
+        self.processed = 0
+        self.last_processing_time = None
+        self._running = False
+        self._reader = None
+        self._worker = None
+        self._lock = threading.Lock()
+        self._started_at = None
+
+    def start(self, url=None):
+        with self._lock:
+            if not self._running:
+                self._running = True
+                self._started_at = time.perf_counter()
+                self._worker = threading.Thread(target=self._process_loop, daemon=True)
+                self._worker.start()
+            if url is not None and url != self.url:
+                self.url = url
+                self._reader = threading.Thread(target=self._read_loop, args=(url,), daemon=True)
+                self._reader.start()
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self.url = None
+
+    def feed(self, chunks):
+        for frame in split_jpeg_stream(chunks):
+            if not self._running:
+                return
+            self.buffer.put(frame)
+
+    def _read_loop(self, url):
+        while self._running and self.url == url:
+            try:
+                with urllib.request.urlopen(url, timeout=10) as response:
+                    chunks = iter(lambda: response.read1(STREAM_CHUNK_SIZE), b"")
+                    for frame in split_jpeg_stream(chunks):
+                        if not self._running or self.url != url:
+                            return
+                        self.buffer.put(frame)
+            except OSError as e:
+                print(f"Camera stream {url} failed: {e}")
+                time.sleep(1)
+
+    def _process_loop(self):
+        #a restarted stream gets a new worker, the old one just exits
+        while self._running and self._worker is threading.current_thread():
+            frame = self.buffer.get(timeout=0.5)
+            if frame is None:
+                continue
+            start = time.perf_counter()
+            try:
+                self.process_frame(frame)
+            except Exception as e:
+                print(f"Processing streamed frame failed: {e}")
+            self.last_processing_time = time.perf_counter() - start
+            self.processed += 1
+
+    def get_stats(self):
+        elapsed = time.perf_counter() - self._started_at if self._started_at else 0
+        return {
+            'running': self._running,
+            'url': self.url,
+            'received': self.buffer.received,
+            'processed': self.processed,
+            'dropped': self.buffer.dropped,
+            'processedFps': self.processed / elapsed if elapsed > 0 else 0,
+            'lastProcessingTime': self.last_processing_time,
+        }
@@ -8,6 +8,8 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CAM_PARAMETERS_DIR = os.path.join(BASE_DIR, "cam_parameters")
 CAMERA_MATRIX_DIR = os.path.join(CAM_PARAMETERS_DIR, "camera_matrix.npy")
 DIST_COEFFS_DIR = os.path.join(CAM_PARAMETERS_DIR, "dist_coeffs.npy")
+#written by src.calibration, both arrays in one file so they are always replaced together
+CALIBRATION_PATH = os.path.join(CAM_PARAMETERS_DIR, "calibration.npz")
 
 def angle_between(v1, v2):
     v1 = v1 / np.linalg.norm(v1)
@@ -21,33 +23,46 @@ def get_marker_positions(marker_size, marker_spacing, rows=5, cols=4):
     marker_positions = {grid[y][x]: marker_grid[y][x] for y in range(grid.shape[0]) for x in range(grid.shape[1])}
     return marker_positions
 
+REDUCED_DECODE_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
 def decode_image(image_bytes):
     nparr = np.frombuffer(image_bytes, np.uint8)
     img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     return img
 
+def decode_image_pyramid(image_bytes, reduction=4):
+    #the full frame is still decoded, the corner refinement, YOLO and the overlay need it, so this costs
+    #more than decode_image, the reduced copy is decoded at a lower DCT scale to keep the extra small
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    reduced_img = cv2.imdecode(nparr, REDUCED_DECODE_FLAGS[reduction])
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    return img, reduced_img
+
 def undistort_image(image):
-    cameraMatrix = np.load(CAMERA_MATRIX_DIR)
-    distCoeffs   = np.load(DIST_COEFFS_DIR)
+    cameraMatrix, distCoeffs = get_camera_matrix_and_dist_coeffs()
     
     undistorted = cv2.undistort(image, cameraMatrix, distCoeffs)
     img = cv2.rotate(undistorted, cv2.ROTATE_90_CLOCKWISE)
     return img
 
 
-def get_camera_position(img, marker_positions, marker_size):
-    img_copy = img.copy()
+def get_camera_position(img, marker_positions, marker_size, reduced_img=None, draw_overlay=True):
+    img_copy = img.copy() if draw_overlay else None
     camera_matrix, dist_coeffs = get_camera_matrix_and_dist_coeffs()
 
-    marker_corners, img_points = get_all_markers(img, marker_positions, marker_size)
+    if reduced_img is not None:
+        marker_corners, img_points = get_all_markers_pyramid(img, reduced_img, marker_positions, marker_size)
+    else:
+        marker_corners, img_points = get_all_markers(img, marker_positions, marker_size)
     
     if marker_corners is None or img_points is None:
         print("No markers detected or matched.")
-        return img_copy, None, None, None, None, None
+        return img_copy, None, None, None, None, None, None
 
-    for i, point in enumerate(img_points):
-        if i%2==0:
-            cv2.circle(img_copy, tuple(point.astype(int)), 5, (255,0,0), -1)
+    if draw_overlay:
+        for i, point in enumerate(img_points):
+            if i%2==0:
+                cv2.circle(img_copy, tuple(point.astype(int)), 5, (255,0,0), -1)
 
     success, rvec, tvec = cv2.solvePnP(
         objectPoints=marker_corners,
@@ -58,10 +73,11 @@ def get_camera_position(img, marker_positions, marker_size):
     )
 
     proj, _ = cv2.projectPoints(marker_corners, rvec, tvec, camera_matrix, dist_coeffs)
-    for p in proj.reshape(-1, 2):
-        cv2.circle(img_copy, tuple(p.astype(int)), 3, (0, 0, 255), -1)
+    if draw_overlay:
+        for p in proj.reshape(-1, 2):
+            cv2.circle(img_copy, tuple(p.astype(int)), 3, (0, 0, 255), -1)
 
-    cv2.drawFrameAxes(img_copy, camera_matrix, dist_coeffs, rvec, tvec, 0.2)
+        cv2.drawFrameAxes(img_copy, camera_matrix, dist_coeffs, rvec, tvec, 0.2)
 
     error = np.mean(np.linalg.norm(img_points - proj.reshape(-1, 2), axis=1))
     print("Reprojection error:", error)
@@ -88,13 +104,46 @@ def get_camera_position(img, marker_positions, marker_size):
     cam_angle = -np.arctan2(v_xy[1], v_xy[0])
     # print(np.degrees(cam_angle))
 
-    return img_copy, camera_position, cam_angle, R, rvec, tvec
+    return img_copy, camera_position, cam_angle, R, rvec, tvec, error
 
 def get_all_markers(img, marker_positions, marker_size=0.036):
     dictionary = aruco.getPredefinedDictionary(aruco.DICT_5X5_100)
     detector = aruco.ArucoDetector(dictionary, aruco.DetectorParameters())
 
     corners, ids, _ = detector.detectMarkers(img)
+    return match_markers(corners, ids, marker_positions, marker_size)
+
+def get_all_markers_pyramid(img, reduced_img, marker_positions, marker_size=0.036, margin=20):
+    """Finds the markers on the reduced image and refines their corners on a full resolution crop.
+
+    Falls back to the full resolution search when the reduced image has no markers.
+    """
+    dictionary = aruco.getPredefinedDictionary(aruco.DICT_5X5_100)
+    detector = aruco.ArucoDetector(dictionary, aruco.DetectorParameters())
+
+    corners, ids, _ = detector.detectMarkers(reduced_img)
+    if ids is None or len(ids) == 0:
+        return get_all_markers(img, marker_positions, marker_size)
+
+    scale = img.shape[1] / reduced_img.shape[1]
+    #pixel centers of the reduced image sit in the middle of scale x scale blocks
+    points = (np.vstack([c.reshape(-1, 2) for c in corners]) + 0.5) * scale - 0.5
+
+    h, w = img.shape[:2]
+    x1, y1 = np.maximum(np.floor(points.min(axis=0)).astype(int) - margin, 0)
+    x2, y2 = np.minimum(np.ceil(points.max(axis=0)).astype(int) + margin, [w, h])
+    crop = cv2.cvtColor(img[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY)
+
+    crop_points = (points - [x1, y1]).astype(np.float32).reshape(-1, 1, 2)
+    window = int(np.ceil(scale)) + 1
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    cv2.cornerSubPix(crop, crop_points, (window, window), (-1, -1), criteria)
+
+    refined = crop_points.reshape(-1, 4, 2) + np.array([x1, y1], dtype=np.float32)
+    corners = [marker.reshape(1, 4, 2) for marker in refined]
+    return match_markers(corners, ids, marker_positions, marker_size)
+
+def match_markers(corners, ids, marker_positions, marker_size=0.036):
     if ids is None or len(ids) == 0:
         return None, None
 
@@ -131,8 +180,7 @@ def get_depth_map(img_left, img_right):
     objPoints, imgPointsLeft = get_all_markers(img_left, markerPositions)
     objPoints, imgPointsRigth = get_all_markers(img_right, markerPositions)
     
-    cameraMatrix = np.load(CAMERA_MATRIX_DIR)
-    distCoeffs   = np.load(DIST_COEFFS_DIR)
+    cameraMatrix, distCoeffs = get_camera_matrix_and_dist_coeffs()
     
     h, w = img_left.shape[:2]
     imageSize = (w, h)
@@ -177,7 +225,23 @@ def get_depth_map(img_left, img_right):
     print("T:", T.ravel())
 
 
+#keyed on the file modification times, so a new calibration is picked up without a restart
+_calibration_cache = {"key": None, "value": None}
+
 def get_camera_matrix_and_dist_coeffs():
-    camera_matrix = np.load(CAMERA_MATRIX_DIR)
-    dist_coeffs = np.load(DIST_COEFFS_DIR)
-    return camera_matrix, dist_coeffs
\ No newline at end of file
+    #a recalibration wins over the .npy files the repository ships with
+    if os.path.exists(CALIBRATION_PATH):
+        key = (CALIBRATION_PATH, os.stat(CALIBRATION_PATH).st_mtime_ns)
+    else:
+        key = (CAMERA_MATRIX_DIR, os.stat(CAMERA_MATRIX_DIR).st_mtime_ns, os.stat(DIST_COEFFS_DIR).st_mtime_ns)
+    if _calibration_cache["key"] != key:
+        if key[0] == CALIBRATION_PATH:
+            with np.load(CALIBRATION_PATH) as calibration:
+                camera_matrix, dist_coeffs = calibration["camera_matrix"], calibration["dist_coeffs"]
+        else:
+            camera_matrix = np.load(CAMERA_MATRIX_DIR)
+            dist_coeffs = np.load(DIST_COEFFS_DIR)
+        _calibration_cache["key"] = key
+        _calibration_cache["value"] = (camera_matrix, dist_coeffs)
+    camera_matrix, dist_coeffs = _calibration_cache["value"]
+    return camera_matrix.copy(), dist_coeffs.copy()
\ No newline at end of file
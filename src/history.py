@@ -0,0 +1,186 @@
+import glob
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from src.state_encoding import BOX_DTYPE
+
+SEGMENT_ROWS = 65536
+#old segments are deleted past either limit, so the disk use stays bounded however long the server runs
+MAX_SEGMENTS = 64
+MAX_AGE = 14 * 24 * 3600
+#a slow stream may not fill a segment for weeks, so the limits are also checked this often on append
+RETENTION_INTERVAL = 3600
+
+POSE_DTYPE = np.dtype([
+    ("time", "<f8"),
+    ("camera_position", "<f8", 3),
+    ("board_angle", "<f8"),
+    ("system_angle", "<f8"),
+    ("translation", "<f8", 3),
+    ("gripper_in_world", "<f8", 3),
+    ("reprojection_error", "<f8"),
+])
+DETECTION_DTYPE = np.dtype([("time", "<f8")] + BOX_DTYPE.descr)
+#servos a command doesn't set are -1
+COMMAND_DTYPE = np.dtype([("time", "<f8"), ("angles", "<i2", 6), ("command", "S32")])
+STREAM_DTYPES = {"poses": POSE_DTYPE, "boxes": DETECTION_DTYPE, "commands": COMMAND_DTYPE}
+
+COMMAND_PATTERN = re.compile(rb"^([PS])([\d:]+)")
+
+def parse_servo_command(command):
+    angles = np.full(6, -1, dtype=np.int16)
+    match = COMMAND_PATTERN.match(command)
+    if match is None:
+        return angles
+    values = [int(v) for v in match.group(2).split(b":") if v]
+    if match.group(1) == b"P":
+        angles[:min(len(values), 5)] = values[:5]
+    elif len(values) == 2 and 0 <= values[0] < 6:
+        angles[values[0]] = values[1]
+    return angles
+
+class HistorySegments:
+    """Append-only, time ordered records of one stream, split into fixed size memory-mapped .npy files.
+
+    Only the segment being written is kept open, queries map the older ones read only
+    and return views into them, so nothing is copied.
+    """
+    def __init__(self, directory, dtype, segment_rows=SEGMENT_ROWS, max_segments=MAX_SEGMENTS, max_age=MAX_AGE,
+                 retention_interval=RETENTION_INTERVAL):
+        self.directory = directory
+        self.dtype = dtype
+        self.segment_rows = segment_rows
+        self.max_segments = max_segments
+        self.max_age = max_age
+        self.retention_interval = retention_interval
+        self._lock = threading.Lock()
+        self._last_retention = -np.inf
+        os.makedirs(directory, exist_ok=True)
+
+        self.active = None
+        self.active_path = None
+        self.active_start = None
+        self.count = 0
+        paths = self.get_segment_paths()
+        if paths:
+            segment = np.load(paths[-1], mmap_mode="r+")
+            #the files start zeroed, the first record without a time is the end
+            count = int(np.count_nonzero(segment["time"]))
+            if segment.dtype == dtype and count < len(segment):
+                self.active, self.active_path, self.count = segment, paths[-1], count
+                self.active_start = self.get_segment_start(paths[-1])
+
+    def get_segment_paths(self):
+        return sorted(glob.glob(os.path.join(self.directory, "*.npy")))
+
+    @staticmethod
+    def get_segment_start(path):
+        return int(os.path.basename(path)[:-4]) / 1e6
+
+    def _open_segment(self, start_time):
+        if self.active is not None:
+            self.active.flush()
+        path = os.path.join(self.directory, f"{int(start_time * 1e6):020d}.npy")
+        self.active = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(self.segment_rows,))
+        self.active_path = path
+        self.active_start = start_time
+        self.count = 0
+
+    def _apply_retention(self, now):
+        self._last_retention = now
+        paths = self.get_segment_paths()
+        for i, path in enumerate(paths[:-1]):
+            #a segment can only go once the next one starts before the cut off
+            next_start = self.get_segment_start(paths[i + 1])
+            if len(paths) - i > self.max_segments or next_start < now - self.max_age:
+                os.remove(path)
+
+    def append(self, records):
+        records = np.atleast_1d(np.asarray(records, dtype=self.dtype))
+        with self._lock:
+            while len(records) > 0:
+                now = records["time"][0]
+                #a segment older than max_age is closed even when it isn't full, so it can be deleted later
+                if self.active is None or self.count == self.segment_rows or self.active_start < now - self.max_age:
+                    self._open_segment(now)
+                    self._apply_retention(now)
+                elif now - self._last_retention >= self.retention_interval:
+                    self._apply_retention(now)
+                n = min(len(records), self.segment_rows - self.count)
+                self.active[self.count:self.count + n] = records[:n]
+                self.count += n
+                records = records[n:]
+
+    def query(self, start=0.0, end=np.inf):
+        """Views of the records with start <= time < end, one per segment."""
+        with self._lock:
+            paths = self.get_segment_paths()
+            active_path, active, count = self.active_path, self.active, self.count
+
+        slices = []
+        for i, path in enumerate(paths):
+            if self.get_segment_start(path) >= end:
+                break
+            if i + 1 < len(paths) and self.get_segment_start(paths[i + 1]) <= start:
+                continue
+            if path == active_path:
+                segment = active[:count]
+            else:
+                segment = np.load(path, mmap_mode="r")
+                segment = segment[:np.count_nonzero(segment["time"])]
+            times = segment["time"]
+            lo, hi = np.searchsorted(times, start, "left"), np.searchsorted(times, end, "left")
+            if hi > lo:
+                slices.append(segment[lo:hi])
+        return slices
+
+    def close(self):
+        with self._lock:
+            if self.active is not None:
+                self.active.flush()
+            self.active = None
+
+class HistoryStore:
+    def __init__(self, directory, **segment_options):
+        self.directory = directory
+        self.streams = {name: HistorySegments(os.path.join(directory, name), dtype, **segment_options)
+                        for name, dtype in STREAM_DTYPES.items()}
+
+    def record_pose(self, camera_position, board_angle, system_angle, translation, gripper_in_world, reprojection_error,
+                    timestamp=None):
+        record = np.zeros(1, dtype=POSE_DTYPE)
+        record["time"] = time.time() if timestamp is None else timestamp
+        record["camera_position"] = camera_position
+        record["board_angle"] = board_angle
+        record["system_angle"] = system_angle
+        record["translation"] = np.ravel(translation)
+        record["gripper_in_world"] = gripper_in_world
+        record["reprojection_error"] = reprojection_error
+        self.streams["poses"].append(record)
+
+    def record_boxes(self, boxes, timestamp=None):
+        if not boxes:
+            return
+        records = np.zeros(len(boxes), dtype=DETECTION_DTYPE)
+        records["time"] = time.time() if timestamp is None else timestamp
+        for name in BOX_DTYPE.names:
+            records[name] = [getattr(box, name) for box in boxes]
+        self.streams["boxes"].append(records)
+
+    def record_command(self, command, timestamp=None):
+        record = np.zeros(1, dtype=COMMAND_DTYPE)
+        record["time"] = time.time() if timestamp is None else timestamp
+        record["angles"] = parse_servo_command(command)
+        record["command"] = command.strip()[:32]
+        self.streams["commands"].append(record)
+
+    def query(self, stream, start=0.0, end=np.inf):
+        return self.streams[stream].query(start, end)
+
+    def close(self):
+        for segments in self.streams.values():
+            segments.close()
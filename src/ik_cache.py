@@ -0,0 +1,119 @@
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from src.movement import get_move_angles
+
+#the servos only take whole degrees, which moves the gripper by a few millimeters anyway
+POSITION_STEP = 0.0005
+TRANSLATION_STEP = 0.001
+SYSTEM_ANGLE_STEP = np.radians(0.5)
+#solutions from far away starts can end up in a different elbow configuration, so they are kept apart
+START_ANGLE_STEP = np.radians(15)
+NEAR_RADIUS = 0.01
+
+def quantize(values, step):
+    return tuple(int(v) for v in np.round(np.asarray(values, dtype=float).ravel() / step))
+
+class IKCache:
+    """Bounded LRU cache of get_move_angles results.
+
+    Exact hits are returned without solving, targets within NEAR_RADIUS of a cached one
+    use its solution as the starting point of the optimizer.
+    """
+    def __init__(self, maxsize=512, near_radius=NEAR_RADIUS):
+        self.maxsize = maxsize
+        self.near_radius = near_radius
+        self.entries = OrderedDict()
+        self.calibration_key = None
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def get_calibration_key(self, translation, system_angle):
+        if translation is None:
+            return None
+        return quantize(translation, TRANSLATION_STEP) + quantize(system_angle, SYSTEM_ANGLE_STEP)
+
+    def get_key(self, target, translation, system_angle, starting_angles, is_in_world_frame):
+        #arm frame solutions don't depend on where the arm is in the world
+        calibration_key = self.get_calibration_key(translation, system_angle) if is_in_world_frame else None
+        return (quantize(target, POSITION_STEP), bool(is_in_world_frame), calibration_key,
+                quantize(np.asarray(starting_angles)[:4], START_ANGLE_STEP))
+
+    def set_calibration(self, translation, system_angle):
+        """Drops the world frame solutions when the arm position in the world changed."""
+        calibration_key = self.get_calibration_key(translation, system_angle)
+        with self._lock:
+            if calibration_key == self.calibration_key:
+                return
+            self.calibration_key = calibration_key
+            for key in [key for key in self.entries if key[1]]:
+                del self.entries[key]
+            self.invalidations += 1
+
+    def _get_nearest(self, key, target):
+        #same frame, calibration and start bucket, closest target within the radius
+        best, best_distance = None, self.near_radius
+        for other_key, (other_target, angles) in self.entries.items():
+            if other_key[1:] != key[1:]:
+                continue
+            distance = np.linalg.norm(other_target - target)
+            if distance <= best_distance:
+                best, best_distance = angles, distance
+        return best
+
+    def get_move_angles(self, target, translation, system_angle, starting_angles, is_in_world_frame=True, solve=get_move_angles):
+        target = np.asarray(target, dtype=float)
+        key = self.get_key(target, translation, system_angle, starting_angles, is_in_world_frame)
+        with self._lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return cached[1].copy()
+            nearest = self._get_nearest(key, target)
+            if nearest is not None:
+                self.near_hits += 1
+            else:
+                self.misses += 1
+
+        angles = solve(target, translation, system_angle, nearest.copy() if nearest is not None else starting_angles,
+                       is_in_world_frame)
+
+        with self._lock:
+            self.entries[key] = (target, angles.copy())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return angles
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def get_memory_usage(self):
+        size = sys.getsizeof(self.entries)
+        for key, (target, angles) in self.entries.items():
+            size += sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key)
+            size += target.nbytes + angles.values.nbytes
+        return size
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "nearHits": self.near_hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "nearHitRate": self.near_hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "memoryBytes": self.get_memory_usage(),
+            }
@@ -0,0 +1,171 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from src.movement import (get_move_angles_refined, transform_world_to_arm_coords, world_to_servo_angles, SERVO_SPEED,
+                          IK_TOLERANCE)
+
+GRIPPER_SERVO_ID = 5
+GRIPPER_OPEN_ANGLE = 160
+GRIPPER_CLOSED_ANGLE = 70
+
+class MotionProgramError(ValueError):
+    pass
+
+def parse_steps(steps, boxes, translation, system_angle, reachability_map=None):
+    """Validates the steps and resolves every move into an arm frame target, before anything runs."""
+    if not isinstance(steps, list) or len(steps) == 0:
+        raise MotionProgramError("A program needs a non-empty list of steps")
+
+    parsed = []
+    for i, step in enumerate(steps):
+        step_type = step.get("type") if isinstance(step, dict) else None
+        if step_type == "move":
+            coords = step.get("coordinates")
+            if not isinstance(coords, list) or len(coords) != 3:
+                raise MotionProgramError(f"Step {i}: coordinates need 3 values")
+            target = np.array(coords, dtype=float)
+            is_in_world_frame = bool(step.get("isWorldFrame", True))
+            parsed.append({"type": "move", "target": target, "isWorldFrame": is_in_world_frame})
+        elif step_type == "grab_box":
+            box = next((box for box in boxes or [] if box.id == int(step.get("box_id", -1))), None)
+            if box is None:
+                raise MotionProgramError(f"Step {i}: box {step.get('box_id')} is not detected")
+            parsed.append({"type": "move", "target": np.array(box.grab_point, dtype=float), "isWorldFrame": True,
+                           "box_id": int(box.id)})
+        elif step_type == "gripper":
+            angle = step.get("angle")
+            if angle is None:
+                action = step.get("action")
+                if action not in ("open", "close"):
+                    raise MotionProgramError(f"Step {i}: gripper needs an angle or action open/close")
+                angle = GRIPPER_OPEN_ANGLE if action == "open" else GRIPPER_CLOSED_ANGLE
+            if not GRIPPER_CLOSED_ANGLE <= int(angle) <= GRIPPER_OPEN_ANGLE:
+                raise MotionProgramError(f"Step {i}: gripper angle {angle} is out of bounds")
+            parsed.append({"type": "gripper", "angle": int(angle)})
+        elif step_type == "wait":
+            seconds = float(step.get("seconds", 0))
+            if seconds < 0:
+                raise MotionProgramError(f"Step {i}: can't wait a negative time")
+            parsed.append({"type": "wait", "seconds": seconds})
+        else:
+            raise MotionProgramError(f"Step {i}: unknown step type {step_type}")
+
+    for i, step in enumerate(parsed):
+        if step["type"] != "move":
+            continue
+        if step["isWorldFrame"]:
+            if translation is None:
+                raise MotionProgramError(f"Step {i}: arm position in world is unknown, take a photo first")
+            step["targetInArm"] = transform_world_to_arm_coords(step["target"], system_angle, translation)
+        else:
+            step["targetInArm"] = step["target"]
+        if reachability_map is not None and not reachability_map.is_reachable(step["targetInArm"]):
+            raise MotionProgramError(f"Step {i}: target {np.round(step['target'], 3).tolist()} is out of reach")
+    return parsed
+
+def solve_program(parsed_steps, starting_angles):
+    """Solves the IK of the move steps that have no angles yet, in one batch started from starting_angles.
+
+    The durations chain from starting_angles through every move, so this has to run with the
+    angles the arm is at when the program starts, not when it was submitted.
+    """
+    moves = [step for step in parsed_steps if step["type"] == "move"]
+    unsolved = [(i, step) for i, step in enumerate(parsed_steps) if step["type"] == "move" and "angles" not in step]
+    if len(unsolved) > 0:
+        targets = np.array([step["targetInArm"] for _, step in unsolved])
+        angles, errors = get_move_angles_refined(targets, starting_angles.values)
+        #the reachability map accepts some targets the solver can't get to, nothing is moved for those
+        for (i, step), error in zip(unsolved, errors):
+            if error > IK_TOLERANCE:
+                raise MotionProgramError(f"Step {i}: no solution reaches {np.round(step['target'], 3).tolist()}, "
+                                         f"the best one is {error * 1000:.0f} mm off")
+        for (_, step), step_angles in zip(unsolved, angles):
+            step["angles"] = step_angles
+
+    previous = starting_angles.values
+    for step in moves:
+        #the servos move together, so the slowest one decides the duration
+        step["duration"] = np.degrees(np.abs(step["angles"][:4] - previous[:4])).max() / SERVO_SPEED
+        previous = step["angles"]
+
+class MotionProgram:
+    def __init__(self, program_id, steps):
+        self.id = program_id
+        self.steps = steps
+        self.status = "pending"
+        self.current_step = None
+        self.events = []
+        self.cancelled = threading.Event()
+        self.add_event("created", steps=len(steps))
+
+    def add_event(self, kind, **info):
+        self.events.append({"time": time.time(), "event": kind, **info})
+
+    def to_dict(self, since=0):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "currentStep": self.current_step,
+            "stepCount": len(self.steps),
+            #known once the program started, the IK is solved from where the arm is then
+            "angles": [world_to_servo_angles(step["angles"]) for step in self.steps if "angles" in step],
+            "events": self.events[since:],
+        }
+
+class MotionProgramRunner:
+    """Runs motion programs one after another on a background thread."""
+    def __init__(self, move, set_gripper, get_start_angles):
+        self.move = move
+        self.set_gripper = set_gripper
+        self.get_start_angles = get_start_angles
+        self.programs = {}
+        self._ids = itertools.count(1)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, steps):
+        program = MotionProgram(next(self._ids), steps)
+        self.programs[program.id] = program
+        self._executor.submit(self._run, program)
+        return program
+
+    def cancel(self, program_id):
+        program = self.programs[program_id]
+        program.cancelled.set()
+        return program
+
+    def _run(self, program):
+        if program.cancelled.is_set():
+            program.status = "cancelled"
+            program.add_event("cancelled")
+            return
+        program.status = "running"
+        program.add_event("started")
+        try:
+            #the previous program decides where this one starts, so the IK can only be solved now
+            solve_program(program.steps, self.get_start_angles())
+            program.add_event("solved")
+            for i, step in enumerate(program.steps):
+                program.current_step = i
+                if step["type"] == "move":
+                    self.move(step["angles"])
+                    wait_time = step["duration"]
+                elif step["type"] == "gripper":
+                    self.set_gripper(step["angle"])
+                    wait_time = abs(GRIPPER_OPEN_ANGLE - GRIPPER_CLOSED_ANGLE) / SERVO_SPEED
+                else:
+                    wait_time = step["seconds"]
+                program.add_event("step", index=i, type=step["type"])
+                #waiting on the event lets a cancel interrupt long moves and waits
+                if program.cancelled.wait(wait_time):
+                    program.status = "cancelled"
+                    program.add_event("cancelled", index=i)
+                    return
+            program.status = "done"
+            program.add_event("done")
+        except Exception as e:
+            program.status = "failed"
+            program.add_event("failed", error=str(e))
@@ -2,71 +2,71 @@ import math
 import os
 import numpy as np
 from scipy.optimize import minimize
-from dataclasses import dataclass
-
-class Angle:
-    def __init__(self, *, rad=None, deg=None):
-        if rad is not None:
-            self._rad = float(rad)
-        elif deg is not None:
-            self._rad = np.radians(deg)
-        else:
-            raise ValueError("Provide radians or degrees")
-
-    def __float__(self):
-        return self._rad
-    
-    def __array__(self, dtype=None):
-        return np.array(self._rad, dtype=dtype)
 
-    @property
-    def rad(self):
-        return self._rad
+JOINT_NAMES = ("alpha", "beta", "gamma", "theta", "psi")
+JOINT_INDEX = {name: i for i, name in enumerate(JOINT_NAMES)}
 
-    @property
-    def deg(self):
-        return np.degrees(self._rad)
+def _joint_view(index):
+    def getter(self):
+        return self.values[index]
 
-    def __add__(self, other):
-        return Angle(rad=self._rad + self._to_rad(other))
+    def setter(self, value):
+        self.values[index] = value
 
-    def __sub__(self, other):
-        return Angle(rad=self._rad - self._to_rad(other))
+    return property(getter, setter)
 
-    def __mul__(self, scalar):
-        return Angle(rad=self._rad * scalar)
+class JointAngles:
+    """Joint angles in radians, stored in a single float64 array in the JOINT_NAMES order."""
+    __slots__ = ("values",)
 
-    def __truediv__(self, scalar):
-        return Angle(rad=self._rad / scalar)
+    alpha = _joint_view(0)
+    beta = _joint_view(1)
+    gamma = _joint_view(2)
+    theta = _joint_view(3)
+    psi = _joint_view(4)
 
-    def __eq__(self, other):
-        return np.isclose(self._rad, self._to_rad(other))
+    def __init__(self, values):
+        self.values = np.array(values, dtype=np.float64)
 
-    def __repr__(self):
-        return f"Angle({self.deg:.2f}°)"
+    @classmethod
+    def from_deg(cls, values):
+        return cls(np.radians(values))
+
+    @property
+    def deg(self):
+        return np.degrees(self.values)
+
+    def copy(self):
+        return JointAngles(self.values)
+
+    def __array__(self, dtype=None, copy=None):
+        #np.array asks for a copy, a caller that changes it mustn't change the joint state
+        if copy:
+            return np.array(self.values, dtype=dtype)
+        return np.asarray(self.values, dtype=dtype)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
 
-    def _to_rad(self, value):
-        if isinstance(value, Angle):
-            return value.rad
-        return float(value)
-    
-@dataclass
-class Angles:
-    alpha: Angle
-    beta: Angle
-    gamma: Angle
-    theta: Angle
-    psi: Angle
-    
     def __getitem__(self, key):
-        if not hasattr(self, key):
-            raise KeyError(key)
-        return getattr(self, key)
-    
+        if isinstance(key, str):
+            if key not in JOINT_INDEX:
+                raise KeyError(key)
+            key = JOINT_INDEX[key]
+        return self.values[key]
+
     def __setitem__(self, key, value):
-        if not hasattr(self, key):
-            raise KeyError(key)
-        setattr(self, key, value)
+        if isinstance(key, str):
+            if key not in JOINT_INDEX:
+                raise KeyError(key)
+            key = JOINT_INDEX[key]
+        self.values[key] = value
+
+    def __repr__(self):
+        return "JointAngles(" + ", ".join(f"{name}={angle:.2f}°" for name, angle in zip(JOINT_NAMES, self.deg)) + ")"
 
 # Robot arm segment lengths in cm
 a = 0.12
@@ -77,30 +77,47 @@ camera_offset_len = 0.016
 baseElevation = 0.132 # 30-32
 # Initial joint angles in degrees
 delta = np.radians(75) #around 78
-offsets = [Angle(deg=-3), Angle(deg=205), Angle(deg=65), Angle(deg=155)]
+offsets = np.radians([-3, 205, 65, 155])
+# Approximate servo speed, used to estimate how long a move takes
+SERVO_SPEED = 300 # deg/s
+#the batch IK results further off than this are refined with the full optimizer
+IK_TOLERANCE = 0.002
+
+angle_bounds = [
+    (offsets[0], offsets[0]+np.pi),       # alpha
+    (offsets[1]-np.pi, offsets[1]),       # beta
+    (offsets[2], offsets[2]+np.pi),       # gamma
+    (np.radians(-150), np.radians(-150+180)),   # theta
+    # (np.radians(-30), np.radians(-30+180))      # psi
+    (0, 0)      # psi
+]
+
+#servo_deg = SERVO_SIGNS * world_deg[SERVO_ORDER] + SERVO_BIAS, servos are [theta, alpha, beta, psi, gamma]
+SERVO_ORDER = np.array([3, 0, 1, 4, 2])
+SERVO_SIGNS = np.array([-1, 1, -1, -1, 1])
+SERVO_BIAS = np.array([30, -np.degrees(offsets[0]), np.degrees(offsets[1]), np.degrees(offsets[3]), -np.degrees(offsets[2])])
+SERVO_TO_JOINT_NAME = [JOINT_NAMES[i] for i in SERVO_ORDER]
 
 def get_initial_angles():
-    alpha = Angle(deg=100) + offsets[0]
-    beta = offsets[1] - Angle(deg=100)
-    gamma = Angle(deg=6) + offsets[2]
-    theta = Angle(deg=0)
-    psi = Angle(deg=0)
-    return Angles(alpha, beta, gamma, theta, psi)
-
-def world_to_servo_angles(angles: Angles):
-    #[theta, alpha, beta, psi, gamma]
-    servo_angles = [Angle(deg=30)-angles.theta, angles.alpha-offsets[0], offsets[1]-angles.beta, offsets[3]-angles.psi, angles.gamma-offsets[2]]
-    return [np.round(angle.deg).astype(int) for angle in servo_angles]
+    alpha = np.radians(100) + offsets[0]
+    beta = offsets[1] - np.radians(100)
+    gamma = np.radians(6) + offsets[2]
+    return JointAngles([alpha, beta, gamma, 0, 0])
+
+def world_to_servo_angles(angles):
+    #works for a single JointAngles or an (N,5) array of world angles
+    world_deg = np.degrees(np.asarray(angles)[..., SERVO_ORDER])
+    return np.rint(world_deg * SERVO_SIGNS + SERVO_BIAS).astype(int)
+
+def servo_to_world_angles(servo_angles):
+    #inverse of world_to_servo_angles, (5,) or (N,5) servo degrees to world radians
+    servo_angles = np.asarray(servo_angles, dtype=np.float64)
+    world_angles = np.empty_like(servo_angles)
+    world_angles[..., SERVO_ORDER] = np.radians((servo_angles - SERVO_BIAS) * SERVO_SIGNS)
+    return world_angles
 
 def servo_to_world_angle(servo_angles: np.ndarray, idx):
-    index_to_name_map = ["theta", "alpha", "beta", "psi", "gamma"]
-    
-    world_angles = [Angle(deg=30)-Angle(deg=servo_angles[0]),
-                        Angle(deg=servo_angles[1])+offsets[0],
-                        offsets[1]-Angle(deg=servo_angles[2]),
-                        offsets[3]-Angle(deg=servo_angles[3]),
-                        Angle(deg=servo_angles[4])+offsets[2]]
-    return (index_to_name_map[idx], world_angles[idx])
+    return (SERVO_TO_JOINT_NAME[idx], servo_to_world_angles(servo_angles)[SERVO_ORDER[idx]])
 
 
 def get_arm_vectors(alpha, beta, gamma, psi): 
@@ -125,10 +142,7 @@ def get_arm_vectors(alpha, beta, gamma, psi):
     return lb, lh
 
 def get_gripper_coords_and_cam_rotation_from_arm(angles):
-    if isinstance(angles, Angles):
-        alpha, beta, gamma, theta, psi = (angles.alpha, angles.beta, angles.gamma, angles.theta, angles.psi)
-    else:
-        alpha, beta, gamma, theta, psi = angles
+    alpha, beta, gamma, theta, psi = angles
     psi=0
     
     lb, lh = get_arm_vectors(alpha, beta, gamma, psi)
@@ -181,9 +195,107 @@ def transform_world_to_arm_coords(p2, alpha, t):
     R = get_rotation_matrix(alpha)
     return R.T @ (p2 - t)
 
+def get_gripper_jacobian(angles):
+    #analytic jacobian of the gripper position in the arm frame with respect to (alpha, beta, gamma, theta)
+    alpha, beta, gamma, theta = angles[0], angles[1], angles[2], angles[3]
+    ab = alpha + beta
+    abg = ab + gamma
+    c_a, s_a = a * math.cos(alpha), a * math.sin(alpha)
+    c_ab, s_ab = b * math.cos(ab), b * math.sin(ab)
+    c_abg, s_abg = c * math.cos(abg), c * math.sin(abg)
+    cos_t, sin_t = math.cos(theta), math.sin(theta)
+
+    r = c_a - c_ab + c_abg
+    dr = (-s_a + s_ab - s_abg, s_ab - s_abg, -s_abg)
+    dz = (c_a - c_ab + c_abg, -c_ab + c_abg, c_abg)
+    return np.array([
+        [dr[0] * cos_t, dr[1] * cos_t, dr[2] * cos_t, -r * sin_t],
+        [dr[0] * sin_t, dr[1] * sin_t, dr[2] * sin_t,  r * cos_t],
+        [dz[0],         dz[1],         dz[2],          0]
+    ])
+
+def get_jog_angles(angles, delta_in_arm, damping=5e-3):
+    """Moves the gripper by a small arm frame delta using the damped pseudo-inverse of the jacobian.
+
+    Meant for small incremental moves, big deltas should go through get_move_angles.
+    """
+    J = get_gripper_jacobian(angles)
+    JJt = J @ J.T
+    JJt[np.diag_indices(3)] += damping ** 2
+    step = J.T @ np.linalg.solve(JJt, delta_in_arm)
+
+    new_angles = np.array(angles, dtype=np.float64)
+    new_angles[:4] += step
+    for i, (low, high) in enumerate(angle_bounds):
+        new_angles[i] = min(max(new_angles[i], low), high)
+    return new_angles
+
+def get_gripper_coords_batch(angles):
+    #angles is (N,5) in the [alpha, beta, gamma, theta, psi] order, psi is ignored like in the single version
+    angles = np.atleast_2d(angles)
+    alpha, beta, gamma, theta = angles[:, 0], angles[:, 1], angles[:, 2], angles[:, 3]
+    ab = alpha + beta
+    abg = ab + gamma
+    #distance from the z axis and height of the gripper in the arm plane
+    r = a * np.cos(alpha) - b * np.cos(ab) + c * np.cos(abg)
+    z = a * np.sin(alpha) - b * np.sin(ab) + c * np.sin(abg) + baseElevation
+    return np.stack([r * np.cos(theta), r * np.sin(theta), z], axis=1)
+
+def get_move_angles_batch(targets_in_arm, starting_angles, iterations=60, damping=1e-2):
+    """Solves the IK for many arm frame targets at once with damped least squares.
+
+    Theta is solved in closed form, the remaining (r, z) problem in the arm plane is
+    solved for all targets together. Returns the (N,5) angles and the position errors.
+    """
+    targets = np.atleast_2d(np.asarray(targets_in_arm, dtype=float))
+    n = len(targets)
+    lower = np.array([bound[0] for bound in angle_bounds])
+    upper = np.array([bound[1] for bound in angle_bounds])
+
+    q = np.tile(np.asarray(starting_angles, dtype=float), (n, 1))
+    theta = np.arctan2(targets[:, 1], targets[:, 0])
+    r_target = np.hypot(targets[:, 0], targets[:, 1])
+    #targets behind the base are reached by leaning backwards with the base turned around
+    behind = (theta < lower[3]) | (theta > upper[3])
+    theta[behind] = np.arctan2(-targets[behind, 1], -targets[behind, 0])
+    r_target[behind] *= -1
+    q[:, 3] = np.clip(theta, lower[3], upper[3])
+    q[:, 4] = 0
+    z_target = targets[:, 2] - baseElevation
+
+    lam2 = damping ** 2
+    for _ in range(iterations):
+        alpha, ab = q[:, 0], q[:, 0] + q[:, 1]
+        abg = ab + q[:, 2]
+        c_a, s_a = a * np.cos(alpha), a * np.sin(alpha)
+        c_ab, s_ab = b * np.cos(ab), b * np.sin(ab)
+        c_abg, s_abg = c * np.cos(abg), c * np.sin(abg)
+
+        err_r = r_target - (c_a - c_ab + c_abg)
+        err_z = z_target - (s_a - s_ab + s_abg)
+
+        #(N,2,3) jacobian of (r, z) with respect to (alpha, beta, gamma)
+        J = np.empty((n, 2, 3))
+        J[:, 0, 2] = -s_abg
+        J[:, 0, 1] = s_ab - s_abg
+        J[:, 0, 0] = -s_a + s_ab - s_abg
+        J[:, 1, 2] = c_abg
+        J[:, 1, 1] = -c_ab + c_abg
+        J[:, 1, 0] = c_a - c_ab + c_abg
+
+        JJt = J @ J.transpose(0, 2, 1)
+        JJt[:, 0, 0] += lam2
+        JJt[:, 1, 1] += lam2
+        err = np.stack([err_r, err_z], axis=1)[:, :, None]
+        step = J.transpose(0, 2, 1) @ np.linalg.solve(JJt, err)
+        q[:, :3] = np.clip(q[:, :3] + step[:, :, 0], lower[:3], upper[:3])
+
+    errors = np.linalg.norm(get_gripper_coords_batch(q) - targets, axis=1)
+    return q, errors
+
 def get_move_angles(target_coords, translation, rotation_angle, starting_angles = get_initial_angles(), is_in_world_frame = True):
     x, y, z = target_coords
-    starting_angles = [starting_angles.alpha.rad, starting_angles.beta.rad, starting_angles.gamma.rad, starting_angles.theta.rad, starting_angles.psi.rad]
+    starting_angles = starting_angles.values
     print("Target: ", target_coords)
     print("Starting angles: ", starting_angles)
     print("Initial angles: ", get_initial_angles())
@@ -201,23 +313,13 @@ def get_move_angles(target_coords, translation, rotation_angle, starting_angles
         # penalty = 5*vars[0]-np.round(vars[0])
         return position_diff + 1e-4 * penalty
 
-    bounds = [
-        (offsets[0].rad, offsets[0].rad+np.pi),       # alpha
-        (offsets[1].rad-np.pi, offsets[1].rad),       # beta
-        (offsets[2].rad, offsets[2].rad+np.pi),       # gamma
-        (np.radians(-150), np.radians(-150+180)),   # theta
-        # (np.radians(-30), np.radians(-30+180))      # psi
-        (0, 0)      # psi
-    ]
-
     result = minimize(
         objective,
         starting_angles,
-        bounds=bounds,
+        bounds=angle_bounds,
     )
     
-    alpha, beta, gamma, theta, psi  = result.x
-    angles_output = Angles(Angle(rad=alpha), Angle(rad=beta), Angle(rad=gamma), Angle(rad=theta), Angle(rad=psi))
+    angles_output = JointAngles(result.x)
     print("Angles: ", angles_output)
     # if result.success or result.fun < 1e-6:
     #     alpha, beta, gamma, theta, psi  = result.x
@@ -226,7 +328,21 @@ def get_move_angles(target_coords, translation, rotation_angle, starting_angles
 
     return angles_output
 
-def conv_camera_coords_to_gripper_coords(camera_coords, angles, coordinate_systems_angle):
+def get_move_angles_refined(targets_in_arm, starting_angles):
+    """get_move_angles_batch, with the targets it misses by more than IK_TOLERANCE solved again by get_move_angles.
+
+    Returns the (N,5) angles and the remaining position errors.
+    """
+    targets = np.atleast_2d(np.asarray(targets_in_arm, dtype=float))
+    angles, errors = get_move_angles_batch(targets, starting_angles)
+    for i in np.flatnonzero(errors > IK_TOLERANCE):
+        angles[i] = get_move_angles(targets[i], None, None, JointAngles(angles[i]), False).values
+    if np.any(errors > IK_TOLERANCE):
+        errors = np.linalg.norm(get_gripper_coords_batch(angles) - targets, axis=1)
+    return angles, errors
+
+def get_camera_disposition(angles):
+    #camera to gripper vector in the arm plane (theta = 0), the camera sits on a mount tilted by delta from the head
     alpha, beta, gamma, theta, psi = (angles.alpha, angles.beta, angles.gamma, angles.theta, angles.psi)
     
     _, arm_head = get_arm_vectors(alpha, beta, gamma, psi)
@@ -238,7 +354,10 @@ def conv_camera_coords_to_gripper_coords(camera_coords, angles, coordinate_syste
     caemra_offset_normalized = camera_offset / np.linalg.norm(camera_offset) * camera_offset_len
     # print(caemra_offset_normalized, "Camera offset")
     # translation_vec = rotate_vec(-caemra_offset_normalized-camera_vector_normalized+arm_head, -coordinate_systems_angle)
-    disposition_vec_in_arm_system = -caemra_offset_normalized-camera_vector_normalized+arm_head
+    return -caemra_offset_normalized-camera_vector_normalized+arm_head
+
+def conv_camera_coords_to_gripper_coords(camera_coords, angles, coordinate_systems_angle):
+    disposition_vec_in_arm_system = get_camera_disposition(angles)
     
     print("Angle is this" , coordinate_systems_angle)
     co, si = np.cos(coordinate_systems_angle), np.sin(coordinate_systems_angle)
@@ -0,0 +1,73 @@
+import numpy as np
+
+from src.movement import get_move_angles_refined, SERVO_SPEED
+
+def get_joint_cost_matrix(angles):
+    #servos move at the same time, so the slowest joint decides how long a move takes
+    angles_deg = np.degrees(np.asarray(angles)[:, :4])
+    return np.abs(angles_deg[:, None, :] - angles_deg[None, :, :]).max(axis=2)
+
+def get_nearest_neighbour_order(cost):
+    #node 0 is the current arm configuration, the path starts there
+    n = len(cost)
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    order = [0]
+    for _ in range(n - 1):
+        costs = np.where(visited, np.inf, cost[order[-1]])
+        next_node = int(np.argmin(costs))
+        visited[next_node] = True
+        order.append(next_node)
+    return np.array(order)
+
+def improve_order_two_opt(order, cost):
+    #open path version of 2-opt, the first node stays fixed and the path doesn't return
+    order = order.copy()
+    n = len(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            j = np.arange(i + 1, n)
+            prev_node, first_node = order[i - 1], order[i]
+            last_nodes = order[j]
+            next_nodes = order[np.minimum(j + 1, n - 1)]
+            has_next = j + 1 < n
+
+            removed = cost[prev_node, first_node] + np.where(has_next, cost[last_nodes, next_nodes], 0)
+            added = cost[prev_node, last_nodes] + np.where(has_next, cost[first_node, next_nodes], 0)
+            gains = removed - added
+
+            best = int(np.argmax(gains))
+            if gains[best] > 1e-9:
+                k = j[best]
+                order[i:k + 1] = order[i:k + 1][::-1]
+                improved = True
+    return order
+
+def get_path_cost(order, cost):
+    return float(cost[order[:-1], order[1:]].sum())
+
+def schedule_picks(grab_points_in_arm, starting_angles, angles=None):
+    """Finds a short visiting order for the grab points, starting from the current angles.
+
+    Returns the order (indexes into grab_points_in_arm), the IK angles of every grab point,
+    the joint travel cost of each move in degrees and the estimated total time in seconds.
+    Angles already solved for the grab points can be passed in.
+    """
+    grab_points_in_arm = np.atleast_2d(grab_points_in_arm)
+    if len(grab_points_in_arm) == 0:
+        return np.array([], dtype=int), np.empty((0, 5)), np.array([]), 0.0
+
+    if angles is None:
+        angles, _ = get_move_angles_refined(grab_points_in_arm, starting_angles)
+    all_angles = np.vstack([np.asarray(starting_angles, dtype=float), angles])
+    cost = get_joint_cost_matrix(all_angles)
+
+    order = get_nearest_neighbour_order(cost)
+    order = improve_order_two_opt(order, cost)
+
+    move_costs = cost[order[:-1], order[1:]]
+    total_time = get_path_cost(order, cost) / SERVO_SPEED
+    #drop the starting configuration and shift back to box indexes
+    return order[1:] - 1, angles, move_costs, total_time
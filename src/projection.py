@@ -0,0 +1,31 @@
+import cv2
+import numpy as np
+
+#swapping the boards x and y and flipping z gives the world frame
+BOARD_TO_WORLD = np.array([
+    [0, 1,  0],
+    [1, 0,  0],
+    [0, 0, -1]
+])
+
+class FrameProjection:
+    """Camera geometry of one frame, computed once and shared by every back-projection of that frame."""
+    def __init__(self, camera_matrix, rvec, tvec):
+        self.R, _ = cv2.Rodrigues(rvec)
+        #image point to board frame ray direction in one matrix
+        self.pixel_to_board_ray = self.R.T @ np.linalg.inv(camera_matrix)
+        self.camera_center = (-self.R.T @ np.asarray(tvec).reshape(3, 1)).ravel()
+        self.camera_position = BOARD_TO_WORLD @ self.camera_center
+
+    def get_rays(self, points):
+        """(N,2) image points to (N,3) unnormalized ray directions in the board frame."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return points @ self.pixel_to_board_ray[:, :2].T + self.pixel_to_board_ray[:, 2]
+
+    def back_project(self, points, heights):
+        """(N,2) image points to (N,3) world points lying on the planes z = heights above the board."""
+        rays = self.get_rays(points)
+        board_z = -np.broadcast_to(np.asarray(heights, dtype=np.float64), len(rays))
+        s = (board_z - self.camera_center[2]) / rays[:, 2]
+        board_points = self.camera_center + s[:, None] * rays
+        return board_points @ BOARD_TO_WORLD.T
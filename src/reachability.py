@@ -0,0 +1,133 @@
+import glob
+import hashlib
+import os
+
+import numpy as np
+from scipy import ndimage
+
+from src.movement import a, b, c, baseElevation, angle_bounds
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REACHABILITY_DIR = os.path.join(BASE_DIR, "reachability_map")
+VOXEL_SIZE = 0.01
+JOINT_SAMPLES = 120
+#bumped when the way the map is built changes, so maps saved by an older version are rebuilt
+MAP_VERSION = 2
+
+class UnreachableTargetError(ValueError):
+    def __init__(self, target_in_arm, nearest_in_arm):
+        super().__init__(f"Target {np.round(target_in_arm, 3).tolist()} is out of reach")
+        self.target_in_arm = target_in_arm
+        self.nearest_in_arm = nearest_in_arm
+
+def get_grid_shape_and_origin(voxel_size):
+    reach = a + b + c
+    origin = np.array([-reach, -reach, baseElevation - reach]) - voxel_size
+    shape = tuple(int(np.ceil((2 * reach) / voxel_size)) + 3 for _ in range(3))
+    return shape, origin
+
+def get_geometry_key(voxel_size):
+    #every constant that changes the workspace goes into the file name, so changing one rebuilds the map
+    geometry = np.array([a, b, c, baseElevation, voxel_size, JOINT_SAMPLES, MAP_VERSION, *np.ravel(angle_bounds)],
+                        dtype=np.float64)
+    return hashlib.sha1(geometry.tobytes()).hexdigest()[:12]
+
+def get_reachable_plane(cell_size):
+    """Reachable (signed distance from the z axis, height) cells of the arm plane, from forward kinematics."""
+    alpha, beta, gamma = (np.linspace(low, high, JOINT_SAMPLES) for low, high in angle_bounds[:3])
+    alpha, beta, gamma = np.meshgrid(alpha, beta, gamma, indexing="ij", sparse=True)
+    ab = alpha + beta
+    abg = ab + gamma
+    r = (a * np.cos(alpha) - b * np.cos(ab) + c * np.cos(abg)).ravel()
+    z = (a * np.sin(alpha) - b * np.sin(ab) + c * np.sin(abg)).ravel() + baseElevation
+
+    reach = a + b + c
+    n = int(np.ceil(2 * reach / cell_size)) + 1
+    plane = np.zeros((n, n), dtype=bool)
+    plane[((r + reach) / cell_size).astype(int), ((z - baseElevation + reach) / cell_size).astype(int)] = True
+    #close the gaps between the joint samples
+    plane = ndimage.binary_closing(plane, iterations=2) | plane
+    return plane, reach
+
+def build_reachability_map(voxel_size=VOXEL_SIZE):
+    shape, origin = get_grid_shape_and_origin(voxel_size)
+    cell_size = voxel_size / 2
+    plane, reach = get_reachable_plane(cell_size)
+
+    centers = [origin[i] + (np.arange(shape[i]) + 0.5) * voxel_size for i in range(3)]
+    x, y, z = np.meshgrid(*centers, indexing="ij")
+    r = np.hypot(x, y)
+    theta = np.arctan2(y, x)
+    #theta covers half a turn, the other half is reached by leaning backwards with a negative r
+    low, high = angle_bounds[3]
+    r = np.where((theta >= low) & (theta <= high), r, -r)
+
+    r_idx = np.floor((r + reach) / cell_size).astype(int)
+    z_idx = np.floor((z - baseElevation + reach) / cell_size).astype(int)
+    inside = (r_idx >= 0) & (r_idx < plane.shape[0]) & (z_idx >= 0) & (z_idx < plane.shape[1])
+    occupancy = np.zeros(shape, dtype=bool)
+    occupancy[inside] = plane[r_idx[inside], z_idx[inside]]
+
+    #the suggested positions come from the voxels the arm reaches all of, the centre of a boundary voxel
+    #can still be a few mm out, and the dilated ones below further still
+    inner = ndimage.binary_erosion(occupancy)
+    nearest = ndimage.distance_transform_edt(~inner, return_distances=False, return_indices=True)
+    nearest = np.moveaxis(nearest, 0, -1).astype(np.int16)
+    #a voxel is only partly reachable at the boundary, rejecting a reachable target is worse than letting the solver try
+    occupancy = ndimage.binary_dilation(occupancy)
+    return occupancy, nearest
+
+class ReachabilityMap:
+    """Voxel map of the positions the gripper can reach in the arm frame.
+
+    Built once from the forward kinematics and the servo bounds, then memory-mapped from disk.
+    Every voxel also stores the index of the nearest reachable voxel.
+    """
+    def __init__(self, occupancy, nearest, voxel_size=VOXEL_SIZE):
+        self.occupancy = occupancy
+        self.nearest = nearest
+        self.voxel_size = voxel_size
+        self.shape, self.origin = get_grid_shape_and_origin(voxel_size)
+
+    @classmethod
+    def load_or_build(cls, voxel_size=VOXEL_SIZE, directory=REACHABILITY_DIR):
+        key = get_geometry_key(voxel_size)
+        occupancy_path = os.path.join(directory, f"occupancy_{key}.npy")
+        nearest_path = os.path.join(directory, f"nearest_{key}.npy")
+
+        if not (os.path.exists(occupancy_path) and os.path.exists(nearest_path)):
+            print("Building reachability map")
+            occupancy, nearest = build_reachability_map(voxel_size)
+            os.makedirs(directory, exist_ok=True)
+            for old_path in glob.glob(os.path.join(directory, "*.npy")):
+                os.remove(old_path)
+            #written under a temporary name first, a half written map would otherwise be loaded next time
+            for path, array in ((occupancy_path, occupancy), (nearest_path, nearest)):
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, array)
+                os.replace(tmp_path, path)
+
+        return cls(np.load(occupancy_path, mmap_mode="r"), np.load(nearest_path, mmap_mode="r"), voxel_size)
+
+    def _get_index(self, point_in_arm):
+        index = np.floor((np.asarray(point_in_arm) - self.origin) / self.voxel_size).astype(int)
+        return tuple(np.clip(index, 0, np.array(self.shape) - 1))
+
+    def is_reachable(self, point_in_arm):
+        index = np.floor((np.asarray(point_in_arm) - self.origin) / self.voxel_size).astype(int)
+        if np.any(index < 0) or np.any(index >= self.shape):
+            return False
+        return bool(self.occupancy[tuple(index)])
+
+    def get_nearest_reachable(self, point_in_arm):
+        nearest_index = self.nearest[self._get_index(point_in_arm)]
+        return self.origin + (nearest_index + 0.5) * self.voxel_size
+
+    def check(self, point_in_arm):
+        if not self.is_reachable(point_in_arm):
+            raise UnreachableTargetError(np.asarray(point_in_arm), self.get_nearest_reachable(point_in_arm))
+
+if __name__ == '__main__':
+    reachability_map = ReachabilityMap.load_or_build()
+    print("Reachable voxels:", int(np.count_nonzero(reachability_map.occupancy)), "of", reachability_map.occupancy.size)
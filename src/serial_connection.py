@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import deque
+
+import serial
+
+BAUDRATE = 9600
+READY_TIMEOUT = 4
+#the line the firmware prints at the end of setup(), the ESP32 prints garbage at another baud rate before it
+FIRMWARE_READY_BANNER = "READY"
+RECONNECT_BACKOFF = 0.5
+MAX_RECONNECT_BACKOFF = 10
+
+class SerialConnection:
+    """Serial port handle that waits for the firmware instead of sleeping and reconnects when the port drops.
+
+    Behaves like the serial.Serial subset the server uses (is_open, write, in_waiting, readline, close).
+    Opened ports are kept in a pool, so closing and reconnecting to the same port from the UI reuses
+    the handle without resetting the board. The firmware counts as ready on the first line containing
+    one of ready_patterns, or on its first line at all without them; after READY_TIMEOUT it is assumed
+    ready anyway.
+    """
+    def __init__(self, baudrate=BAUDRATE, ready_timeout=READY_TIMEOUT, ready_patterns=None, on_ready=None):
+        self.baudrate = baudrate
+        self.ready_timeout = ready_timeout
+        self.ready_patterns = ready_patterns
+        self.on_ready = on_ready
+        self.port = None
+        self.time_to_ready = None
+        self._handle = None
+        self._pool = {}
+        self._lines = deque()
+        self._lock = threading.RLock()
+        self._reconnecting = False
+        self._cancel_reconnect = threading.Event()
+        self._reconnect_done = threading.Event()
+        self._reconnect_done.set()
+
+    def open(self, port):
+        """Returns True if the port was reused from the pool."""
+        self._stop_reconnect()
+        with self._lock:
+            self.port = port
+            handle = self._pool.get(port)
+            if handle is not None and handle.is_open:
+                self._handle = handle
+                self.time_to_ready = 0
+                return True
+
+            self._handle = self._open_handle(port)
+            return False
+
+    def _open_handle(self, port):
+        handle = serial.Serial(port, self.baudrate, timeout=0.1)
+        start = time.perf_counter()
+        ready = self._wait_until_ready(handle)
+        self.time_to_ready = time.perf_counter() - start
+        if not ready:
+            print(f"No answer from {port} after {self.ready_timeout} s, assuming it is ready")
+        self._pool[port] = handle
+        return handle
+
+    def _is_ready_line(self, line):
+        if self.ready_patterns is None:
+            return True
+        return any(pattern in line for pattern in self.ready_patterns)
+
+    def _wait_until_ready(self, handle):
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.ready_timeout:
+            line = handle.readline().decode('utf-8', errors='ignore').strip()
+            if not line:
+                continue
+            #keep the boot messages for the serial monitor
+            self._lines.append(line.encode() + b"\n")
+            if self._is_ready_line(line):
+                return True
+        return False
+
+    @property
+    def is_open(self):
+        return self._handle is not None and self._handle.is_open and not self._reconnecting
+
+    @property
+    def in_waiting(self):
+        try:
+            return sum(len(line) for line in self._lines) + (self._handle.in_waiting if self.is_open else 0)
+        except (serial.SerialException, OSError):
+            self._handle_drop()
+            return 0
+
+    def readline(self):
+        if self._lines:
+            return self._lines.popleft()
+        try:
+            return self._handle.readline()
+        except (serial.SerialException, OSError):
+            self._handle_drop()
+            return b""
+
+    def write(self, data):
+        with self._lock:
+            try:
+                return self._handle.write(data)
+            except (serial.SerialException, OSError):
+                self._handle_drop()
+                raise
+
+    def close(self, release=False):
+        """Releases the port but keeps the handle open in the pool, unless release is set.
+
+        A released port is closed at the OS level, so it can be flashed or opened by a serial monitor,
+        the next open resets the board again.
+        """
+        self._stop_reconnect()
+        with self._lock:
+            if release and self.port is not None:
+                handle = self._pool.pop(self.port, None)
+                if handle is not None:
+                    handle.close()
+            self._handle = None
+            self.port = None
+
+    def close_all(self):
+        self._stop_reconnect()
+        with self._lock:
+            for handle in self._pool.values():
+                handle.close()
+            self._pool.clear()
+            self._handle = None
+            self.port = None
+
+    def _handle_drop(self):
+        with self._lock:
+            if self._reconnecting or self._handle is None:
+                return
+            print(f"Lost connection to {self.port}, reconnecting")
+            try:
+                self._handle.close()
+            except (serial.SerialException, OSError):
+                pass
+            self._pool.pop(self.port, None)
+            self._reconnecting = True
+            self._cancel_reconnect.clear()
+            self._reconnect_done.clear()
+        threading.Thread(target=self._reconnect, args=(self.port,), daemon=True).start()
+
+    def _stop_reconnect(self):
+        #a reconnect left running would open the port a second time or put its handle in place of the new one,
+        #it is only waited for while it opens the port, not while on_ready runs
+        self._cancel_reconnect.set()
+        self._reconnect_done.wait()
+
+    def _reconnect(self, port):
+        backoff = RECONNECT_BACKOFF
+        handle = None
+        try:
+            while not self._cancel_reconnect.is_set():
+                try:
+                    handle = self._open_handle(port)
+                    break
+                except (serial.SerialException, OSError):
+                    #waiting on the event lets open and close stop the retries right away
+                    self._cancel_reconnect.wait(backoff)
+                    backoff = min(backoff * 2, MAX_RECONNECT_BACKOFF)
+            with self._lock:
+                if handle is None or self._cancel_reconnect.is_set():
+                    return
+                self._handle = handle
+        finally:
+            with self._lock:
+                self._reconnecting = False
+            self._reconnect_done.set()
+        print(f"Reconnected to {port}")
+        if self.on_ready is not None:
+            self.on_ready()
@@ -0,0 +1,237 @@
+"""Production serving: HTTP workers in front of one owner process.
+
+The serial port, the camera stream, the model and all the arm state live in flask_app, which
+only the owner process imports. Every HTTP worker runs OwnerProxy, a small WSGI app that forwards
+the request over a local multiprocessing.connection socket and streams the response back.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Without the owner address in the environment create_app returns the flask app itself,
+for running everything in a single process.
+
+The owner runs one thread per worker connection, flask_app serializes the handlers that change
+the arm state with its state_lock. The owner is not restarted when it dies, the workers answer
+502 until the server is restarted.
+"""
+import io
+import os
+import tempfile
+import threading
+import time
+from multiprocessing import get_context
+from multiprocessing.connection import Client, Listener
+
+OWNER_ADDRESS_ENV = "ROBOTIC_ARM_OWNER_ADDRESS"
+OWNER_AUTHKEY_ENV = "ROBOTIC_ARM_OWNER_AUTHKEY"
+#the owner loads the reachability map and the model before it listens
+OWNER_CONNECT_TIMEOUT = 60
+BODY_CHUNK_SIZE = 64 * 1024
+#an empty message ends a request or response body
+END_OF_BODY = b""
+
+class ConnectionReader(io.RawIOBase):
+    """wsgi.input of the owner, reads the request body chunks as the worker sends them."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = b""
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and not self.done:
+            chunk = self.conn.recv_bytes()
+            if chunk == END_OF_BODY:
+                self.done = True
+            else:
+                self.buffer = chunk
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def drain(self):
+        while not self.done:
+            if self.conn.recv_bytes() == END_OF_BODY:
+                self.done = True
+        self.buffer = b""
+
+def handle_connection(app, conn):
+    with conn:
+        while True:
+            try:
+                environ = conn.recv()
+            except (EOFError, OSError):
+                return
+            reader = ConnectionReader(conn)
+            environ.update({
+                "wsgi.version": (1, 0),
+                "wsgi.input": io.BufferedReader(reader, BODY_CHUNK_SIZE),
+                #the body ends with END_OF_BODY, also when the client sent it chunked
+                "wsgi.input_terminated": True,
+                "wsgi.errors": io.StringIO(),
+                "wsgi.multithread": True,
+                "wsgi.multiprocess": False,
+                "wsgi.run_once": False,
+            })
+            response = {}
+
+            def start_response(status, headers, exc_info=None):
+                response["status"] = status
+                response["headers"] = headers
+
+            try:
+                result = app(environ, start_response)
+            except Exception as e:
+                print("Owner failed on", environ.get("PATH_INFO"), e)
+                result = [b"Internal Server Error"]
+                start_response("500 INTERNAL SERVER ERROR", [("Content-Type", "text/plain")])
+            #the worker sends the whole body before it reads the response
+            reader.drain()
+            try:
+                headers_sent = False
+                for chunk in result:
+                    if not headers_sent:
+                        conn.send((response["status"], response["headers"]))
+                        headers_sent = True
+                    if chunk:
+                        conn.send_bytes(chunk)
+                if not headers_sent:
+                    conn.send((response["status"], response["headers"]))
+                conn.send_bytes(END_OF_BODY)
+            except (EOFError, OSError):
+                return
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+
+def run_owner(address, authkey):
+    """Entry point of the owner process, serves the workers until it is terminated."""
+    from flask_app import app
+
+    listener = Listener(address, authkey=authkey)
+    print("Owner listening on", address)
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            #a client with the wrong key, the others carry on
+            print("Owner rejected a connection:", e)
+            continue
+        threading.Thread(target=handle_connection, args=(app, conn), daemon=True).start()
+
+def start_owner(address=None):
+    """Starts the owner process and puts its address and key in the environment for the workers."""
+    if address is None:
+        address = os.path.join(tempfile.gettempdir(), f"robotic-arm-owner-{os.getpid()}.sock")
+    if os.path.exists(address):
+        os.remove(address)
+    authkey = os.urandom(16)
+    os.environ[OWNER_ADDRESS_ENV] = address
+    os.environ[OWNER_AUTHKEY_ENV] = authkey.hex()
+    #spawned, not forked, so the owner doesn't inherit anything from the server process
+    process = get_context("spawn").Process(target=run_owner, args=(address, authkey), name="robotic-arm-owner")
+    process.start()
+    return process
+
+def stop_owner(process):
+    process.terminate()
+    process.join(5)
+    address = os.environ.get(OWNER_ADDRESS_ENV)
+    if address and os.path.exists(address):
+        os.remove(address)
+
+class OwnerProxy:
+    """WSGI app of the HTTP workers, one owner connection per worker thread."""
+    def __init__(self, address, authkey, connect_timeout=OWNER_CONNECT_TIMEOUT):
+        self.address = address
+        self.authkey = authkey
+        self.connect_timeout = connect_timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                return Client(self.address, authkey=self.authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def _drop_connection(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+    def _send_request(self, environ):
+        #only the plain CGI and HTTP values travel, the owner adds its own wsgi.* keys
+        request = {key: value for key, value in environ.items() if isinstance(value, str)}
+        for attempt in range(2):
+            conn = getattr(self._local, "conn", None)
+            if conn is None:
+                conn = self._local.conn = self._connect()
+            try:
+                conn.send(request)
+                return conn
+            except (EOFError, OSError):
+                #the owner closed this connection since the last request, a fresh one is tried once
+                self._drop_connection()
+                if attempt == 1:
+                    raise
+
+    def _send_body(self, conn, environ):
+        stream = environ["wsgi.input"]
+        length = environ.get("CONTENT_LENGTH")
+        if length:
+            remaining = int(length)
+        elif environ.get("HTTP_TRANSFER_ENCODING", "").lower() == "chunked":
+            #only read to the end when the server says the stream ends, otherwise it would wait on the socket
+            remaining = None if environ.get("wsgi.input_terminated") else 0
+        else:
+            remaining = 0
+        while remaining is None or remaining > 0:
+            chunk = stream.read(BODY_CHUNK_SIZE if remaining is None else min(BODY_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            conn.send_bytes(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+        conn.send_bytes(END_OF_BODY)
+
+    def _iter_body(self, conn):
+        finished = False
+        try:
+            while True:
+                chunk = conn.recv_bytes()
+                if chunk == END_OF_BODY:
+                    finished = True
+                    return
+                yield chunk
+        finally:
+            #a client that went away mid response leaves the connection in an unknown state
+            if not finished:
+                self._drop_connection()
+
+    def __call__(self, environ, start_response):
+        try:
+            conn = self._send_request(environ)
+            self._send_body(conn, environ)
+            status, headers = conn.recv()
+        except (EOFError, OSError) as e:
+            self._drop_connection()
+            start_response("502 BAD GATEWAY", [("Content-Type", "text/plain")])
+            return [f"Owner process unavailable: {e}".encode()]
+        start_response(status, headers)
+        return self._iter_body(conn)
+
+def create_app(owner_address=None, authkey=None):
+    owner_address = owner_address or os.environ.get(OWNER_ADDRESS_ENV)
+    if owner_address is None:
+        from flask_app import app
+        return app
+    if authkey is None:
+        authkey = bytes.fromhex(os.environ[OWNER_AUTHKEY_ENV])
+    return OwnerProxy(owner_address, authkey)
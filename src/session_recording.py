@@ -0,0 +1,84 @@
+import json
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+SESSION_MAGIC = b"RACSESS1"
+#timestamp since the start of the session, record kind, payload length
+RECORD_HEADER = struct.Struct("<dBI")
+
+FRAME = 1
+SERIAL_OUT = 2
+SERIAL_IN = 3
+COMMAND = 4
+
+KIND_NAMES = {FRAME: "frame", SERIAL_OUT: "serial_out", SERIAL_IN: "serial_in", COMMAND: "command"}
+
+SessionRecord = namedtuple("SessionRecord", ["timestamp", "kind", "payload"])
+
+class SessionRecorder:
+    """Appends frames, serial traffic and API commands to a session file.
+
+    Every record is a fixed size header followed by the raw payload, frames are stored
+    as the uploaded JPEG bytes and commands as JSON.
+    """
+    def __init__(self):
+        self._file = None
+        self._start_time = None
+        self._lock = threading.Lock()
+        self.path = None
+
+    @property
+    def is_recording(self):
+        return self._file is not None
+
+    def start(self, path):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._file = open(path, "wb")
+            self._file.write(SESSION_MAGIC)
+            self._start_time = time.perf_counter()
+            self.path = path
+
+    def stop(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = None
+            path, self.path = self.path, None
+            return path
+
+    def record(self, kind, payload, timestamp=None):
+        if self._file is None:
+            return
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self._lock:
+            if self._file is None:
+                return
+            if timestamp is None:
+                timestamp = time.perf_counter()
+            self._file.write(RECORD_HEADER.pack(timestamp - self._start_time, kind, len(payload)))
+            self._file.write(payload)
+
+    def record_command(self, method, path, body, duration, timestamp=None):
+        self.record(COMMAND, json.dumps({"method": method, "path": path, "body": body, "duration": duration}), timestamp)
+
+def read_session(path):
+    with open(path, "rb") as f:
+        if f.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+            raise ValueError(f"{path} is not a session recording")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, kind, length = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                #the recording was cut off while writing the last record
+                return
+            yield SessionRecord(timestamp, kind, payload)
@@ -0,0 +1,108 @@
+import struct
+
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPE = "application/x-msgpack"
+#fixed layout: STATE_HEADER, then BOX_DTYPE records, then an optional length prefixed JPEG
+STATE_MIMETYPE = "application/vnd.robotic-arm.state"
+
+STATE_MAGIC = b"RAS1"
+STATE_VERSION = 1
+FLAG_HAS_IMAGE = 1
+#magic, version, flags, box count, gripper in world, gripper in arm, servo angles
+STATE_HEADER = struct.Struct("<4sBBH3d3d5h")
+IMAGE_LENGTH = struct.Struct("<I")
+BOX_DTYPE = np.dtype([("id", "<i4"), ("grab_point", "<f8", 3), ("width", "<f8"), ("length", "<f8"), ("height", "<f8")])
+
+class NumpyJSONProvider(DefaultJSONProvider):
+    """JSON provider that understands numpy types, using orjson when it is installed."""
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        if isinstance(obj, (np.integer,)):
+            return int(obj)
+        if isinstance(obj, (np.floating,)):
+            return float(obj)
+        return super().default(obj)
+
+    def dumps(self, obj, **kwargs):
+        #indented output is only used in debug mode, leave it to the standard encoder
+        if orjson is None or kwargs.get("indent"):
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+def pack_boxes(boxes):
+    packed = np.empty(len(boxes), dtype=BOX_DTYPE)
+    if len(boxes) == 0:
+        return packed
+    packed["id"] = [box.id for box in boxes]
+    packed["grab_point"] = [box.grab_point for box in boxes]
+    packed["width"] = [box.width for box in boxes]
+    packed["length"] = [box.length for box in boxes]
+    packed["height"] = [box.height for box in boxes]
+    return packed
+
+def encode_state_struct(world_coords, arm_coords, servo_angles, boxes, image_bytes=None):
+    flags = FLAG_HAS_IMAGE if image_bytes is not None else 0
+    header = STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION, flags, len(boxes),
+                               *map(float, world_coords), *map(float, arm_coords), *map(int, servo_angles))
+    parts = [header, pack_boxes(boxes).tobytes()]
+    if image_bytes is not None:
+        parts += [IMAGE_LENGTH.pack(len(image_bytes)), image_bytes]
+    return b"".join(parts)
+
+def decode_state_struct(data):
+    magic, version, flags, box_count, *values = STATE_HEADER.unpack_from(data)
+    if magic != STATE_MAGIC or version != STATE_VERSION:
+        raise ValueError("Not a robotic arm state message")
+    offset = STATE_HEADER.size
+    boxes = np.frombuffer(data, dtype=BOX_DTYPE, count=box_count, offset=offset)
+    offset += boxes.nbytes
+    image_bytes = None
+    if flags & FLAG_HAS_IMAGE:
+        (length,) = IMAGE_LENGTH.unpack_from(data, offset)
+        offset += IMAGE_LENGTH.size
+        image_bytes = data[offset:offset + length]
+    return {
+        "worldCoords": np.array(values[0:3]),
+        "armCoords": np.array(values[3:6]),
+        "angles": np.array(values[6:11]),
+        "boxes": boxes,
+        "image": image_bytes,
+    }
+
+def _pack_for_msgpack(value):
+    #arrays go out as raw little endian float64 bytes, box lists as BOX_DTYPE records
+    if isinstance(value, np.ndarray):
+        return value.astype("<f8").tobytes()
+    if isinstance(value, list) and value and hasattr(value[0], "grab_point"):
+        return pack_boxes(value).tobytes()
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    return value
+
+def encode_msgpack(data):
+    return msgpack.packb({key: _pack_for_msgpack(value) for key, value in data.items()}, default=_pack_for_msgpack)
+
+def get_response_mimetypes():
+    mimetypes = [JSON_MIMETYPE, STATE_MIMETYPE]
+    if msgpack is not None:
+        mimetypes.append(MSGPACK_MIMETYPE)
+    return mimetypes
@@ -0,0 +1,319 @@
+import argparse
+import contextlib
+import io
+import os
+import pty
+import select
+import tempfile
+import threading
+import time
+import tty
+import urllib.request
+import uuid
+
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+
+from src.camera_utils import get_marker_positions, get_camera_matrix_and_dist_coeffs
+from src.serial_connection import FIRMWARE_READY_BANNER
+from src.movement import (get_initial_angles, world_to_servo_angles, servo_to_world_angles,
+                          get_gripper_coords_and_cam_rotation_from_arm, transform_arm_to_world_coords,
+                          get_rotation_matrix, get_camera_disposition, JointAngles, SERVO_SPEED)
+
+BAUDRATE = 9600
+#start bit + 8 data bits + stop bit
+BITS_PER_BYTE = 10
+BOOT_TIME = 1.5
+#the ROM boot log of the ESP32 comes at 115200 baud and reads as garbage at BAUDRATE
+BOOT_NOISE = "\u00e0\u00f8x\u00f8\u00e0\u00f0\u00f8"
+BOOT_BANNER = FIRMWARE_READY_BANNER
+GRIPPER_INITIAL_ANGLE = 160
+
+MARKER_SIZE = 0.036
+MARKER_SPACING = 0.005
+#swapping world x and y and flipping z, the same as the board to world transform
+BOARD_TRANSFORM = np.array([
+    [0, 1,  0],
+    [1, 0,  0],
+    [0, 0, -1]
+])
+
+def get_board_texture(marker_size=MARKER_SIZE, marker_spacing=MARKER_SPACING, px_per_m=4000, margin=0.02):
+    dictionary = aruco.getPredefinedDictionary(aruco.DICT_5X5_100)
+    marker_positions = get_marker_positions(marker_size, marker_spacing)
+    max_x = max(p[0] for p in marker_positions.values()) + marker_size
+    max_y = max(p[1] for p in marker_positions.values()) + marker_size
+
+    w = int((max_x + 2 * margin) * px_per_m)
+    h = int((max_y + 2 * margin) * px_per_m)
+    texture = np.full((h, w), 255, dtype=np.uint8)
+    side = int(marker_size * px_per_m)
+    for marker_id, (x, y, _) in marker_positions.items():
+        u = int((x + margin) * px_per_m)
+        v = int((y + margin) * px_per_m)
+        texture[v:v + side, u:u + side] = aruco.generateImageMarker(dictionary, int(marker_id), side)
+
+    #texture pixel to board coordinates in meters
+    texture_to_board = np.array([
+        [1 / px_per_m, 0, -margin],
+        [0, 1 / px_per_m, -margin],
+        [0, 0, 1]
+    ])
+    return cv2.cvtColor(texture, cv2.COLOR_GRAY2BGR), texture_to_board
+
+def get_distortion_maps(camera_matrix, dist_coeffs):
+    #for every pixel of the distorted frame, where it is in the ideal pinhole image
+    w, h = int(round(camera_matrix[0, 2] * 2)), int(round(camera_matrix[1, 2] * 2))
+    grid = np.stack(np.meshgrid(np.arange(w), np.arange(h)), axis=-1).reshape(-1, 1, 2).astype(np.float32)
+    undistorted = cv2.undistortPoints(grid, camera_matrix, dist_coeffs, P=camera_matrix).reshape(h, w, 2)
+    return undistorted[..., 0].copy(), undistorted[..., 1].copy()
+
+def render_board_frame(camera_position_in_world, camera_angle, camera_matrix, texture, texture_to_board, distortion_maps=None,
+                       quality=80):
+    """Renders the board as seen by a camera looking straight down and returns the JPEG bytes.
+
+    camera_angle is the angle get_camera_position reads back from the frame.
+    """
+    camera_position = BOARD_TRANSFORM @ camera_position_in_world
+    #get_camera_position takes minus the direction of the board y axis in the image, and the board
+    #frame is a reflection of the world frame, so the rotation of the board in the image is the opposite
+    yaw = -camera_angle - np.pi / 2
+    co, si = np.cos(yaw), np.sin(yaw)
+    R = np.array([
+        [co, -si, 0],
+        [si,  co, 0],
+        [0,   0,  1]
+    ])
+    t = -R @ camera_position
+    #homography of the z=0 board plane
+    H = camera_matrix @ np.column_stack([R[:, 0], R[:, 1], t]) @ texture_to_board
+
+    size = (int(round(camera_matrix[0, 2] * 2)), int(round(camera_matrix[1, 2] * 2)))
+    frame = cv2.warpPerspective(texture, H, size, borderValue=(180, 180, 180))
+    if distortion_maps is not None:
+        frame = cv2.remap(frame, distortion_maps[0], distortion_maps[1], cv2.INTER_LINEAR)
+    _, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+def post_frame(url, jpeg_bytes):
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"imageFile\"; filename=\"frame.jpg\"\r\n"
+            f"Content-Type: image/jpeg\r\n\r\n").encode() + jpeg_bytes + f"\r\n--{boundary}--\r\n".encode()
+    req = urllib.request.Request(url, data=body, method="POST",
+                                 headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    with urllib.request.urlopen(req, timeout=30) as response:
+        return response.status
+
+class VirtualArm:
+    """Simulated arm and camera speaking the firmware serial protocol on a pseudo-terminal.
+
+    Connect to it by passing `port` to /api/connect. Writes and reads are delayed like a real
+    UART at BAUDRATE and servos move towards their targets at SERVO_SPEED. By default the arm
+    is placed so that the camera starts above the middle of the board.
+    """
+    def __init__(self, server_port=5000, arm_translation=(-0.01, 0.08, 0.0), arm_angle=np.pi,
+                 baudrate=BAUDRATE, boot_time=BOOT_TIME, texture=None, distortion_maps=None):
+        self.server_port = server_port
+        self.arm_translation = np.array(arm_translation, dtype=float)
+        self.arm_angle = arm_angle
+        self.byte_time = BITS_PER_BYTE / baudrate
+        self.boot_time = boot_time
+        self.texture, self.texture_to_board = texture if texture is not None else get_board_texture()
+        self.camera_matrix, dist_coeffs = get_camera_matrix_and_dist_coeffs()
+        self.distortion_maps = distortion_maps if distortion_maps is not None else get_distortion_maps(self.camera_matrix, dist_coeffs)
+
+        servo_angles = list(world_to_servo_angles(get_initial_angles())) + [GRIPPER_INITIAL_ANGLE]
+        self.servo_angles = np.array(servo_angles, dtype=float)
+        self.servo_targets = self.servo_angles.copy()
+        self.last_update = time.perf_counter()
+        #when the servos reach the latest targets, "Position reached" is sent from the _run loop then
+        self.reached_at = None
+        self.active = False
+        self.frames_sent = 0
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = False
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _send(self, line):
+        data = (line + "\r\n").encode()
+        with self._write_lock:
+            time.sleep(len(data) * self.byte_time)
+            os.write(self._master, data)
+
+    def _update_servos(self):
+        now = time.perf_counter()
+        max_step = SERVO_SPEED * (now - self.last_update)
+        self.last_update = now
+        diff = self.servo_targets - self.servo_angles
+        self.servo_angles += np.clip(diff, -max_step, max_step)
+
+    def _set_targets(self, targets):
+        self._update_servos()
+        for servo_id, angle in targets.items():
+            self.servo_targets[servo_id] = angle
+        travel_time = np.abs(self.servo_targets - self.servo_angles).max() / SERVO_SPEED
+        #a new command before the last one finished replaces it, like on the firmware
+        self.reached_at = time.perf_counter() + travel_time
+
+    def get_camera_pose(self):
+        """Camera position in world and camera angle, the inverse of what the server does with a frame."""
+        self._update_servos()
+        world_angles = JointAngles(servo_to_world_angles(self.servo_angles[:5]))
+        gripper_in_arm, _ = get_gripper_coords_and_cam_rotation_from_arm(world_angles)
+        gripper_in_world = transform_arm_to_world_coords(gripper_in_arm, self.arm_angle, self.arm_translation)
+        #the camera turns with theta on top of the arm angle, its offset from the gripper is given in the arm plane
+        camera_angle = self.arm_angle + world_angles.theta
+        camera_in_world = gripper_in_world - get_rotation_matrix(camera_angle) @ get_camera_disposition(world_angles)
+        return camera_in_world, camera_angle
+
+    def take_photo(self, ip):
+        camera_position, camera_angle = self.get_camera_pose()
+        frame = render_board_frame(camera_position, camera_angle, self.camera_matrix, self.texture, self.texture_to_board,
+                                   self.distortion_maps)
+        try:
+            post_frame(f"http://{ip}:{self.server_port}/get_position", frame)
+            self.frames_sent += 1
+            self._send("Photo sent")
+        except Exception as e:
+            self._send(f"Photo failed: {e}")
+
+    def handle_command(self, command):
+        if command == "activate":
+            self.active = True
+            self._send("Activated")
+        elif command.startswith("take_photo:"):
+            threading.Thread(target=self.take_photo, args=(command.split(":", 1)[1],), daemon=True).start()
+        elif command.startswith("P"):
+            angles = [int(x) for x in command[1:].split(":")]
+            self._send(f"Moving to {command[1:]}")
+            self._set_targets(dict(enumerate(angles)))
+        elif command.startswith("S"):
+            servo_id, angle = (int(x) for x in command[1:].split(":"))
+            self._send(f"Servo {servo_id} -> {angle}")
+            self._set_targets({servo_id: angle})
+        else:
+            self._send(f"Unknown command: {command}")
+
+    def _run(self):
+        self._send(BOOT_NOISE)
+        time.sleep(self.boot_time)
+        self._send(BOOT_BANNER)
+        buffer = b""
+        while self._running:
+            timeout = 0.1
+            if self.reached_at is not None:
+                timeout = min(timeout, max(0.0, self.reached_at - time.perf_counter()))
+            readable, _, _ = select.select([self._master], [], [], timeout)
+            if self.reached_at is not None and time.perf_counter() >= self.reached_at:
+                self.reached_at = None
+                self._send("Position reached")
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                break
+            #the firmware only sees the bytes once they went over the wire
+            time.sleep(len(data) * self.byte_time)
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                command = line.decode(errors="ignore").strip()
+                if command:
+                    try:
+                        self.handle_command(command)
+                    except ValueError:
+                        self._send(f"Bad command: {command}")
+
+#servo offsets from the initial pose the round trip check photographs the board from
+CHECK_POSES = [(0, 0, 0, 0, 0), (10, 0, 0, 0, 0), (-15, 5, -5, 0, 0), (0, 10, 0, 0, 0)]
+CHECK_TRANSLATION_TOLERANCE = 0.005
+CHECK_ANGLE_TOLERANCE = np.radians(0.5)
+
+def check_round_trip(arm, poses=CHECK_POSES):
+    """Sends frames of the arm through /get_position and compares the transform the server recovers.
+
+    Runs the server in this process with a throwaway history, returns True if every pose is within the tolerances.
+    """
+    history_dir = tempfile.mkdtemp()
+    os.environ["ROBOTIC_ARM_HISTORY_DIR"] = history_dir
+    import flask_app
+
+    #the frames would otherwise replace the last photo of the real camera
+    flask_app.LATEST_IMAGE_PATH = os.path.join(history_dir, "latest.jpg")
+    client = flask_app.app.test_client()
+    initial_servo_angles = world_to_servo_angles(get_initial_angles())
+    ok = True
+    for offsets in poses:
+        servo_angles = np.array(initial_servo_angles, dtype=float) + offsets
+        arm.servo_angles[:5] = servo_angles
+        arm.servo_targets[:] = arm.servo_angles
+        #the server knows the angles from the commands it sent, here they are set directly
+        flask_app.world_angles = JointAngles(servo_to_world_angles(servo_angles))
+        flask_app.current_gripper_position_in_arm, _ = get_gripper_coords_and_cam_rotation_from_arm(flask_app.world_angles)
+        flask_app.arm_transform.reset()
+
+        camera_position, camera_angle = arm.get_camera_pose()
+        frame = render_board_frame(camera_position, camera_angle, arm.camera_matrix, arm.texture, arm.texture_to_board,
+                                   arm.distortion_maps)
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.post("/get_position", data={"imageFile": (io.BytesIO(frame), "frame.jpg")},
+                                   content_type="multipart/form-data")
+        if response.status_code != 200:
+            print(f"Pose {offsets}: no board found")
+            ok = False
+            continue
+        translation_error = np.linalg.norm(flask_app.translation - arm.arm_translation)
+        angle_error = abs((flask_app.system_angle - arm.arm_angle + np.pi) % (2 * np.pi) - np.pi)
+        pose_ok = translation_error <= CHECK_TRANSLATION_TOLERANCE and angle_error <= CHECK_ANGLE_TOLERANCE
+        ok = ok and pose_ok
+        print(f"Pose {offsets}: translation off by {translation_error * 1000:.1f} mm, "
+              f"angle off by {np.degrees(angle_error):.2f} deg{'' if pose_ok else ', FAILED'}")
+    return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run simulated arms on pseudo-terminals")
+    parser.add_argument("--count", type=int, default=1, help="number of simulated arms")
+    parser.add_argument("--server-port", type=int, default=5000, help="port of the Flask server that receives the photos")
+    parser.add_argument("--boot-time", type=float, default=BOOT_TIME)
+    parser.add_argument("--check", action="store_true",
+                        help="check that the server recovers the arm position and angle from the frames, then exit")
+    args = parser.parse_args()
+
+    texture = get_board_texture()
+    distortion_maps = get_distortion_maps(*get_camera_matrix_and_dist_coeffs())
+    if args.check:
+        arm = VirtualArm(args.server_port, texture=texture, distortion_maps=distortion_maps)
+        ok = check_round_trip(arm)
+        arm.stop()
+        raise SystemExit(0 if ok else 1)
+    arms = [VirtualArm(args.server_port, boot_time=args.boot_time, texture=texture, distortion_maps=distortion_maps).start()
+            for _ in range(args.count)]
+    for arm in arms:
+        print(arm.port)
+    try:
+        while True:
+            time.sleep(5)
+            print("Frames sent:", sum(arm.frames_sent for arm in arms))
+    except KeyboardInterrupt:
+        for arm in arms:
+            arm.stop()
@@ -0,0 +1,3 @@
+from src.serving import create_app
+
+app = create_app()